@@ -0,0 +1,55 @@
+"""Micro-benchmark do pré-processamento para OCR (antigo x novo).
+
+Uso (dentro do container ou com as dependências instaladas):
+    python benchmarks/bench_preprocessamento.py [repeticoes]
+"""
+import os
+import sys
+import time
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from streamlit_pdf_auth_ui.preprocessamento import preprocess_variants  # noqa: E402
+
+# Página A4 renderizada em cada DPI
+TAMANHOS = {200: (1654, 2339), 300: (2480, 3508)}
+
+
+def preprocess_variants_antigo(image):
+    """Implementação anterior: duas conversões para cinza e lambda por pixel"""
+    variants = []
+    gray1 = image.convert("L")
+    variants.append(gray1.point(lambda x: 0 if x < 180 else 255))
+    gray2 = image.convert("L")
+    variants.append(gray2.point(lambda x: 0 if x < 160 else 255))
+    return variants
+
+
+def preprocess_variants_novo(image):
+    return [variant for _, variant in preprocess_variants(image)]
+
+
+def pagina_sintetica(tamanho):
+    """Página RGB com ruído, parecida com um scan"""
+    return Image.effect_noise(tamanho, 64).convert("RGB")
+
+
+def medir(funcao, imagem, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao(imagem)
+    return (time.perf_counter() - inicio) / repeticoes * 1000
+
+
+def main():
+    repeticoes = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for dpi, tamanho in TAMANHOS.items():
+        imagem = pagina_sintetica(tamanho)
+        antigo = medir(preprocess_variants_antigo, imagem, repeticoes)
+        novo = medir(preprocess_variants_novo, imagem, repeticoes)
+        print(f"{dpi} dpi {tamanho[0]}x{tamanho[1]}: antigo {antigo:.1f} ms | novo {novo:.1f} ms "
+              f"(todas as variantes, {antigo / novo:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ st.set_page_config(
 # Suprimir avisos de uma categoria específica
 #st.set_option('deprecation.showfileUploaderEncoding', False)
 #st.set_option('deprecation.showPyplotGlobalUse', False)
+# Migrações e usuários iniciais: só a primeira execução do processo acessa o banco
 init_db()
 
 # Inicializa a interface de login
@@ -1,19 +1,94 @@
 import streamlit as st
-from pdf2image import convert_from_bytes
-import pytesseract
 from PIL import Image
-import io
-import re
 import os
 import time
 import schedule
 import threading
 from datetime import datetime, timedelta
+from .processamento import processar_em_paralelo, obter_num_workers, LIMITE_MB
+from .armazenamento import (DIRETORIO_BASE, criar_estrutura_diretorios, publicar_parte, descartar_partes, parte_disponivel, remover_lote,
+                           zip_lote_pronto, montar_zip_lote)
 
 # Configuração do Tesseract para Docker (Linux)
 # pytesseract.pytesseract.tesseract_cmd = r"C:/Program Files/Tesseract-OCR/tesseract.exe"  # Windows
 # No Docker, o Tesseract está instalado no PATH do sistema
 
+def _nomear_partes(diretorio_lote, resultado):
+    """Dá nome definitivo às partes que o worker gravou e retorna os descritores"""
+    if resultado['erro']:
+        descartar_partes(resultado['partes'])
+        return []
+    numero_guia = resultado['numero_guia']
+    arquivos = []
+    try:
+        for idx, parte in enumerate(resultado['partes']):
+            if numero_guia:
+                nome_arquivo = f"{numero_guia}_GUIA_DOC{idx+1}.pdf"
+                tipo = 'com_guia'
+            else:
+                nome_arquivo = f"SEM_GUIA_{resultado['nome'].replace('.pdf', '')}_SEM_GUIA_DOC{idx+1}.pdf"
+                tipo = 'sem_guia'
+            arquivos.append(publicar_parte(diretorio_lote, parte, nome_arquivo, tipo, numero_guia))
+    except OSError as e:
+        resultado['erro'] = f"Falha ao gravar {resultado['nome']} no disco: {str(e)}"
+        st.error(f"❌ Erro ao processar PDF: {resultado['erro']}")
+        descartar_partes(arquivos + resultado['partes'][len(arquivos):])
+        return []
+    return arquivos
+
+def _montar_zip(diretorio_lote, processed_files, comprimir):
+    """Monta (ou reaproveita) o ZIP do lote no disco e retorna o caminho; None em caso de erro"""
+    if zip_lote_pronto(diretorio_lote, processed_files, comprimir):
+        caminho_zip, ausentes = montar_zip_lote(diretorio_lote, processed_files, comprimir)
+    else:
+        progress_bar = st.progress(0)
+        status_text = st.empty()
+
+        def progresso(i, total, nome):
+            progress_bar.progress(i / total)
+            status_text.text(f"Adicionando arquivo {i}/{total}: {nome}")
+
+        try:
+            caminho_zip, ausentes = montar_zip_lote(diretorio_lote, processed_files, comprimir, progresso)
+        except Exception as e:
+            st.error(f"❌ Erro ao criar ZIP: {str(e)}")
+            st.error(f"Detalhes do erro: {type(e).__name__}")
+            return None
+        finally:
+            progress_bar.empty()
+            status_text.empty()
+
+    for nome in ausentes:
+        st.warning(f"⚠️ Arquivo {nome} não possui dados válidos.")
+    if len(ausentes) == len(processed_files):
+        st.error("❌ Erro: ZIP vazio. Verifique se os arquivos foram processados corretamente.")
+        return None
+    return caminho_zip
+
+def _download_sob_demanda(rotulo, caminho, nome_arquivo, mime, key, rotulo_download="💾 Download"):
+    """Botão de download que só lê o arquivo do disco depois do clique.
+
+    Enquanto o usuário não pede o arquivo, só um botão leve é desenhado; o
+    conteúdo é lido e registrado no Streamlit apenas para o arquivo
+    escolhido (um por vez), então o custo de um rerun não cresce com o lote.
+    """
+    preparado = st.session_state.get("download_preparado") == key
+    if not preparado and st.button(rotulo, key=f"preparar_{key}"):
+        st.session_state["download_preparado"] = key
+        preparado = True
+    if preparado:
+        if not os.path.isfile(caminho):
+            st.warning("Arquivo removido do servidor")
+            return
+        with open(caminho, 'rb') as arquivo:
+            st.download_button(
+                label=rotulo_download,
+                data=arquivo,
+                file_name=nome_arquivo,
+                mime=mime,
+                key=key
+            )
+
 def run_ai_pdf():
     """Função principal do AI PDF Scanner"""
     # CONFIGURAÇÃO
@@ -67,111 +142,11 @@ def run_ai_pdf():
     st.info("💡 **Dica**: Para melhor performance, evite processar múltiplos PDFs simultaneamente em diferentes abas.")
 
     # FUNÇÕES
-    def preprocess_variants(image):
-        """Retorna uma lista de variações da imagem pré-processada para OCR"""
-        variants = []
-
-        # Versão 1: Mais clara
-        gray1 = image.convert("L")
-        bin1 = gray1.point(lambda x: 0 if x < 180 else 255)
-        variants.append(bin1)
-
-        # Versão 2: Mais escura/adaptativa
-        gray2 = image.convert("L")
-        bin2 = gray2.point(lambda x: 0 if x < 160 else 255)
-        variants.append(bin2)
-
-        return variants
-
-    def extract_card_number(text):
-        pattern = r"(?:Nº|No|Número|Guia)\s*(?:Guia)?\s*(?:no|nº|número)?\s*Prestador[:\s]*([0-9]{6,})"
-        match = re.search(pattern, text, re.IGNORECASE)
-        return match.group(1) if match else None
-
-    def reduzir_ou_dividir_pdf(pdf_bytes, max_mb=200, max_partes=10, dpi_inicial=300, dpi_min=100, qualidade_jpeg=95):
-        """
-        Divide o PDF em partes de até `max_mb` MB (padrão: 200MB).
-        Gera apenas o número necessário de partes, com máximo de `max_partes`.
-        Reduz qualidade automaticamente se necessário.
-        """
-        dpi_atual = dpi_inicial
-        qualidade_atual = qualidade_jpeg
-
-        while dpi_atual >= dpi_min:
-            imagens = convert_from_bytes(pdf_bytes, dpi=dpi_atual)
-            partes = []
-            paginas_atual = []
-            tamanho_atual = 0
-
-            for imagem in imagens:
-                buffer_temp = io.BytesIO()
-                imagem.save(buffer_temp, format="PDF", quality=qualidade_atual)
-                tamanho_pagina = len(buffer_temp.getvalue())
-
-                if (tamanho_atual + tamanho_pagina) > (max_mb * 1024 * 1024):
-                    if paginas_atual:
-                        buffer_parte = io.BytesIO()
-                        paginas_atual[0].save(
-                            buffer_parte, format="PDF", save_all=True,
-                            append_images=paginas_atual[1:], quality=qualidade_atual
-                        )
-                        partes.append(buffer_parte.getvalue())
-
-                    paginas_atual = [imagem]
-                    tamanho_atual = tamanho_pagina
-                else:
-                    paginas_atual.append(imagem)
-                    tamanho_atual += tamanho_pagina
-
-            # Salvar a última parte
-            if paginas_atual:
-                buffer_parte = io.BytesIO()
-                paginas_atual[0].save(
-                    buffer_parte, format="PDF", save_all=True,
-                    append_images=paginas_atual[1:], quality=qualidade_atual
-                )
-                partes.append(buffer_parte.getvalue())
-
-            # ✅ Aqui está o controle correto: só retorna se o número de partes está dentro do limite
-            if len(partes) <= max_partes:
-                return partes
-
-            # Se ultrapassou, reduz a qualidade e tenta novamente
-            dpi_atual -= 50
-            qualidade_atual = max(50, qualidade_atual - 10)
-
-        # Se não foi possível dividir com qualidade reduzida
-        raise ValueError("Não foi possível dividir o PDF em até 10 partes de 3MB, mesmo com qualidade reduzida.")
-
-    def preprocess_image(image):
-        gray = image.convert("L")  # Grayscale
-        # Binarização com threshold adaptativo
-        return gray.point(lambda x: 0 if x < 160 else 255)
-
-    # Função para criar estrutura de diretórios
-    def criar_estrutura_diretorios():
-        """Cria a estrutura de diretórios para organizar os arquivos processados"""
-        try:
-            # Criar diretório base se não existir
-            base_dir = "/app/processed_pdfs"
-            if not os.path.exists(base_dir):
-                os.makedirs(base_dir, exist_ok=True)
-            
-            # Criar diretório específico para este processamento
-            if st.session_state.get("timestamp_pasta"):
-                timestamp_dir = os.path.join(base_dir, st.session_state["timestamp_pasta"])
-                if not os.path.exists(timestamp_dir):
-                    os.makedirs(timestamp_dir, exist_ok=True)
-                return timestamp_dir
-        except Exception as e:
-            st.warning(f"⚠️ Não foi possível criar estrutura de diretórios: {str(e)}")
-        return None
-
     # Função para limpeza automática de arquivos antigos
     def limpar_arquivos_antigos():
         """Remove arquivos processados com mais de 24 horas"""
         try:
-            base_dir = "/app/processed_pdfs"
+            base_dir = DIRETORIO_BASE
             if not os.path.exists(base_dir):
                 return
             
@@ -244,47 +219,6 @@ def run_ai_pdf():
         iniciar_scheduler_limpeza()
         st.session_state["scheduler_iniciado"] = True
 
-    # NOVA LÓGICA: OCR antes da compressão com otimizações
-    def encontrar_numero_guia(pdf_bytes):
-        try:
-            # Reduzir DPI para economizar memória e CPU
-            imagens = convert_from_bytes(pdf_bytes, dpi=200)  # Era 300, agora 200
-            
-            # Limitar a busca apenas na primeira página para velocidade
-            for page_index, imagem in enumerate(imagens[:1]):  # Só primeira página
-                angles = [0, 90, -90, 180]
-                for angle in angles:
-                    rotated = imagem.rotate(angle, expand=True)
-
-                    for variant in preprocess_variants(rotated):
-                        # Configuração otimizada para velocidade
-                        config = r'--oem 1 --psm 6'  # Mais rápido que oem 3
-                        text = pytesseract.image_to_string(variant, lang="por+eng", config=config)
-                        numero = extract_card_number(text)
-                        if numero:
-                            return numero, len(imagens)
-            
-            # Se não encontrou na primeira página, tenta segunda (sem timeout para evitar erro de signal)
-            if len(imagens) > 1:
-                try:
-                    imagem = imagens[1]
-                    angles = [0, 90, -90, 180]
-                    for angle in angles:
-                        rotated = imagem.rotate(angle, expand=True)
-                        for variant in preprocess_variants(rotated):
-                            config = r'--oem 1 --psm 6'
-                            text = pytesseract.image_to_string(variant, lang="por+eng", config=config)
-                            numero = extract_card_number(text)
-                            if numero:
-                                return numero, len(imagens)
-                except Exception as e:
-                    st.warning(f"⚠️ Erro no OCR da segunda página: {str(e)}. Continuando...")
-                    
-        except Exception as e:
-            st.error(f"❌ Erro no OCR: {str(e)}")
-            
-        return None, len(imagens)
-
     # PROCESSAMENTO PRINCIPAL
     if uploaded_files and st.session_state["nome_pasta"]:
         # Verificar se a pasta foi criada
@@ -298,6 +232,8 @@ def run_ai_pdf():
             
             # Botão para forçar reprocessamento se necessário
             if st.button("🔄 Reprocessar Arquivos (substituirá os arquivos atuais)"):
+                remover_lote(st.session_state.get("diretorio_lote"))
+                st.session_state["diretorio_lote"] = None
                 st.session_state["processed_files"] = []
                 st.session_state["timestamp_pasta"] = ""  # Resetar timestamp para gerar novo
                 st.session_state["processing_lock"] = False
@@ -314,127 +250,143 @@ def run_ai_pdf():
         
         # Ativar lock de processamento
         st.session_state["processing_lock"] = True
+        try:
+            # Verificar tamanho total dos arquivos antes do processamento
+            total_upload_size = sum(len(file.read()) for file in uploaded_files)
+            total_upload_size_mb = total_upload_size / (1024 * 1024)
         
-        # Verificar tamanho total dos arquivos antes do processamento
-        total_upload_size = sum(len(file.read()) for file in uploaded_files)
-        total_upload_size_mb = total_upload_size / (1024 * 1024)
-        
-        if total_upload_size_mb > 1000:  # Mais de 1GB
-            st.error(f"❌ Arquivos muito grandes detectados. Tamanho total: {total_upload_size_mb:.1f} MB. Recomendamos processar arquivos menores.")
-            return
+            if total_upload_size_mb > 1000:  # Mais de 1GB
+                st.error(f"❌ Arquivos muito grandes detectados. Tamanho total: {total_upload_size_mb:.1f} MB. Recomendamos processar arquivos menores.")
+                return
         
-        # Resetar arquivos para leitura
-        for file in uploaded_files:
-            file.seek(0)
+            # Resetar arquivos para leitura
+            for file in uploaded_files:
+                file.seek(0)
         
-        start_time = time.time()
-        sucesso = 0
-        compactados = 0
-        nao_encontrados = 0
-        processed_files = []
-
-        for uploaded_file in uploaded_files:
-            st.divider()
-            st.subheader(f"📄 Processando: {uploaded_file.name}")
-
-            original_pdf_bytes = uploaded_file.read()
-            tamanho_mb = len(original_pdf_bytes) / (1024 * 1024)
-
-            # EXTRAIR NÚMERO ANTES DE VERIFICAR TAMANHO
-            with st.spinner("🔍 Realizando a leitura do arquivo..."):
-                numero_guia, total_paginas = encontrar_numero_guia(original_pdf_bytes)
-
-            st.info(f"Total de páginas no PDF: {total_paginas}")
-
-            if numero_guia:
-                st.success(f"🔢 Número da guia encontrado: {numero_guia}")
-            else:
-                st.warning("⚠️ Número 'Nº Guia no Prestador:' não encontrado na primeira página.")
-            
-                                # REDUZIR SE NECESSÁRIO
-            if tamanho_mb > 200:
-                st.warning(f"⚠️ Arquivo excede 200MB ({tamanho_mb:.2f} MB). Tentando dividir e reduzir qualidade automaticamente...")
-
-                try:
-                    partes_pdf = reduzir_ou_dividir_pdf(original_pdf_bytes, max_mb=200, max_partes=10)
-                    compactados += 1
-                except ValueError as e:
-                    st.error(f"❌ Erro ao processar PDF: {e}")
+            # As partes processadas vão para o disco, no diretório deste lote
+            if not st.session_state["timestamp_pasta"]:
+                st.session_state["timestamp_pasta"] = f"{time.strftime('%Y%m%d_%H%M%S')}_{username}_{st.session_state['protocolo_atual']}"
+            try:
+                diretorio_lote = criar_estrutura_diretorios(st.session_state["timestamp_pasta"])
+            except OSError as e:
+                st.error(f"❌ Não foi possível criar o diretório dos arquivos processados: {str(e)}")
+                return
+            st.session_state["diretorio_lote"] = diretorio_lote
+
+            start_time = time.time()
+            sucesso = 0
+            compactados = 0
+            nao_encontrados = 0
+            via_texto = 0
+            cache_hits = 0
+            processed_files = []
+
+            arquivos = [(uploaded_file.name, uploaded_file) for uploaded_file in uploaded_files]  # Lidos sob demanda
+            workers = obter_num_workers()
+            st.info(f"⚙️ Processando {len(arquivos)} arquivo(s) com até {workers} processo(s) em paralelo.")
+            progress_bar = st.progress(0)
+
+            # Os resultados chegam na ordem em que terminam; os workers já gravaram as
+            # partes no disco com nome provisório
+            resultados = {}
+            with st.spinner("🔍 Realizando a leitura dos arquivos..."):
+                for concluidos, resultado in enumerate(processar_em_paralelo(arquivos, diretorio_lote, workers), start=1):
+                    resultados[resultado['indice']] = resultado
+                    progress_bar.progress(concluidos / len(arquivos))
+
+                    st.divider()
+                    st.subheader(f"📄 Processado: {resultado['nome']}")
+                    for aviso in resultado['avisos']:
+                        st.warning(aviso)
+
+                    if resultado['cache_hit']:
+                        st.caption("♻️ Resultado reaproveitado do cache (arquivo já processado antes).")
+                    st.info(f"Total de páginas no PDF: {resultado['total_paginas']}")
+                    if resultado['tipos_pagina']:
+                        st.caption("Páginas lidas: " + ", ".join(
+                            f"{i+1} ({'texto' if tipo == 'texto' else 'só imagem'})"
+                            for i, tipo in enumerate(resultado['tipos_pagina'])
+                        ))
+
+                    if resultado['numero_guia']:
+                        dpi = resultado['resultado_ocr'].get('dpi')
+                        metodo = "camada de texto" if resultado['metodo'] == "texto" else (f"OCR a {dpi} dpi" if dpi else "OCR")
+                        st.success(f"🔢 Número da guia encontrado: {resultado['numero_guia']} (via {metodo})")
+                    else:
+                        st.warning("⚠️ Número 'Nº Guia no Prestador:' não encontrado na primeira página.")
+
+                    if resultado['tamanho_mb'] > LIMITE_MB:
+                        st.warning(f"⚠️ Arquivo excede {LIMITE_MB}MB ({resultado['tamanho_mb']:.2f} MB). Dividido e reduzido automaticamente.")
+                    if resultado['erro']:
+                        st.error(f"❌ Erro ao processar PDF: {resultado['erro']}")
+
+            progress_bar.empty()
+
+            # Processar e armazenar arquivos na sessão. Os nomes definitivos são dados
+            # na ordem do upload, então o sufixo de guia repetida é determinístico
+            for indice in sorted(resultados):
+                resultado = resultados[indice]
+                resultado['arquivos'] = _nomear_partes(diretorio_lote, resultado)
+                if resultado['cache_hit']:
+                    cache_hits += 1
+                if resultado['erro']:
                     continue
-            else:
-                partes_pdf = [original_pdf_bytes]
+                if resultado['compactado']:
+                    compactados += 1
 
-            # Processar e armazenar arquivos na sessão
-            if numero_guia:
-                for idx, parte in enumerate(partes_pdf):
-                    sufixo_parte = f"_GUIA_DOC{idx+1}.pdf"
-                    nome_arquivo = f"{numero_guia}{sufixo_parte}"
-                    
-                    processed_files.append({
-                        'nome': nome_arquivo,
-                        'dados': parte,
-                        'tipo': 'com_guia',
-                        'numero_guia': numero_guia
-                    })
-                st.success(f"✅ PDF processado: {numero_guia}_GUIA_DOC*.pdf")
-                sucesso += 1
-            else:
-                for idx, parte in enumerate(partes_pdf):
-                    sufixo_parte = f"_SEM_GUIA_DOC{idx+1}.pdf"
-                    nome_arquivo = f"SEM_GUIA_{uploaded_file.name.replace('.pdf', '')}{sufixo_parte}"
-                    
-                    processed_files.append({
-                        'nome': nome_arquivo,
-                        'dados': parte,
-                        'tipo': 'sem_guia',
-                        'numero_guia': None
-                    })
-
-                st.info(f"📂 PDF sem número processado: {nome_arquivo}")
-                nao_encontrados += 1
-
-        # Armazenar arquivos processados na sessão
-        st.session_state["processed_files"] = processed_files
-
-        # Verificar se os arquivos foram armazenados corretamente
-        if processed_files:
-            total_size_bytes = sum(len(file_info['dados']) for file_info in processed_files)
-            st.info(f"📏 Total de arquivos processados: {len(processed_files)}")
-            st.info(f"📏 Tamanho total em bytes: {total_size_bytes:,}")
-            
-            # Verificar se todos os arquivos têm dados válidos
-            arquivos_validos = sum(1 for file_info in processed_files if file_info.get('dados'))
-            if arquivos_validos != len(processed_files):
-                st.warning(f"⚠️ Apenas {arquivos_validos} de {len(processed_files)} arquivos têm dados válidos.")
-            
-            # Debug: mostrar informações detalhadas dos arquivos
-            st.info("🔍 **Debug - Informações dos arquivos processados:**")
-            for i, file_info in enumerate(processed_files):
-                dados_size = len(file_info.get('dados', b''))
-                st.write(f"  - Arquivo {i+1}: {file_info['nome']} | Dados: {dados_size} bytes | Tipo: {file_info['tipo']}")
-
-        # RESUMO
-        total = len(uploaded_files)
-        st.divider()
-        st.header("📊 Resumo do processamento")
-        st.markdown(f"""
-        - 📂 Arquivos processados: **{total}**
-        - ✅ Arquivos com número da guia encontrado: **{sucesso}**
-        - 📉 Arquivos compactados (reduzidos/divididos): **{compactados}**
-        - ❌ Arquivos sem número da guia: **{nao_encontrados}**
-        """)
-        elapsed_time = time.time() - start_time
-        minutes, seconds = divmod(int(elapsed_time), 60)
-        st.info(f"🕒 Tempo total de execução: **{minutes} min {seconds} seg**")
-        
-        # Verificar se há arquivos processados para mostrar seção de download
-        if processed_files:
-            st.success("✅ **Processamento concluído!** A seção de download aparecerá abaixo.")
-        else:
-            st.warning("⚠️ **Nenhum arquivo foi processado com sucesso.** Verifique os erros acima.")
+                if resultado['metodo'] == "texto":
+                    via_texto += 1
+
+                processed_files.extend(resultado['arquivos'])
+                if resultado['numero_guia']:
+                    sucesso += 1
+                else:
+                    nao_encontrados += 1
+
+            # Armazenar na sessão só os descritores (caminho, tamanho, hash, guia)
+            st.session_state["processed_files"] = processed_files
+            st.session_state.pop("download_preparado", None)
+
+            # Verificar se os arquivos foram armazenados corretamente
+            if processed_files:
+                total_size_bytes = sum(file_info['tamanho'] for file_info in processed_files)
+                st.info(f"📏 Total de arquivos processados: {len(processed_files)}")
+                st.info(f"📏 Tamanho total em bytes: {total_size_bytes:,}")
+            
+                # Verificar se todos os arquivos têm dados válidos
+                arquivos_validos = sum(1 for file_info in processed_files if file_info['tamanho'] and parte_disponivel(file_info))
+                if arquivos_validos != len(processed_files):
+                    st.warning(f"⚠️ Apenas {arquivos_validos} de {len(processed_files)} arquivos têm dados válidos.")
+            
+                # Debug: mostrar informações detalhadas dos arquivos
+                st.info("🔍 **Debug - Informações dos arquivos processados:**")
+                for i, file_info in enumerate(processed_files):
+                    st.write(f"  - Arquivo {i+1}: {file_info['nome']} | Dados: {file_info['tamanho']} bytes | Tipo: {file_info['tipo']} | Caminho: {file_info['caminho']}")
+
+            # RESUMO
+            total = len(uploaded_files)
+            st.divider()
+            st.header("📊 Resumo do processamento")
+            st.markdown(f"""
+            - 📂 Arquivos processados: **{total}**
+            - ✅ Arquivos com número da guia encontrado: **{sucesso}**
+            - ⚡ Encontrados pela camada de texto (sem OCR): **{via_texto}**
+            - ♻️ Cache de OCR: **{cache_hits}/{total}** ({(cache_hits / total * 100) if total else 0:.0f}% de acerto)
+            - 📉 Arquivos compactados (reduzidos/divididos): **{compactados}**
+            - ❌ Arquivos sem número da guia: **{nao_encontrados}**
+            """)
+            elapsed_time = time.time() - start_time
+            minutes, seconds = divmod(int(elapsed_time), 60)
+            st.info(f"🕒 Tempo total de execução: **{minutes} min {seconds} seg**")
         
-        # Liberar lock de processamento
-        st.session_state["processing_lock"] = False
+            # Verificar se há arquivos processados para mostrar seção de download
+            if processed_files:
+                st.success("✅ **Processamento concluído!** A seção de download aparecerá abaixo.")
+            else:
+                st.warning("⚠️ **Nenhum arquivo foi processado com sucesso.** Verifique os erros acima.")
+        finally:
+            # Liberar lock de processamento, inclusive em retorno antecipado ou erro
+            st.session_state["processing_lock"] = False
 
     elif uploaded_files and not st.session_state["nome_pasta"]:
         st.error("⚠️ Crie o nome da pasta antes de processar os arquivos.")
@@ -493,7 +445,7 @@ def run_ai_pdf():
                 """)
             
             # Calcular tamanho total dos arquivos
-            total_size = sum(len(file_info['dados']) for file_info in st.session_state["processed_files"])
+            total_size = sum(file_info['tamanho'] for file_info in st.session_state["processed_files"])
             total_size_mb = total_size / (1024 * 1024)
             
             st.info(f"📏 Tamanho total: {total_size_mb:.2f} MB")
@@ -503,89 +455,42 @@ def run_ai_pdf():
                 st.warning("⚠️ Arquivos muito grandes detectados. Recomendamos download individual para melhor performance.")
             
             # Opções de download baseadas no tamanho
+            diretorio_lote = st.session_state.get("diretorio_lote") or os.path.dirname(st.session_state["processed_files"][0]['caminho'])
             col1, col2 = st.columns(2)
             
             with col1:
                 # Download rápido (sem compressão) para arquivos menores
                 if total_size_mb < 100:  # Menos de 100MB
-                    if st.button("⚡ Download Rápido (ZIP sem compressão)"):
-                        import zipfile
-                        
-                        progress_bar = st.progress(0)
-                        status_text = st.empty()
-                        
-                        try:
-                            zip_buffer = io.BytesIO()
-                            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:  # Sem compressão
-                                total_files = len(st.session_state["processed_files"])
-                                
-                                for i, file_info in enumerate(st.session_state["processed_files"]):
-                                    progress = (i + 1) / total_files
-                                    progress_bar.progress(progress)
-                                    status_text.text(f"Adicionando arquivo {i+1}/{total_files}: {file_info['nome']}")
-                                    zip_file.writestr(file_info['nome'], file_info['dados'])
-                            
-                            zip_buffer.seek(0)
-                            progress_bar.progress(1.0)
-                            status_text.text("✅ ZIP criado com sucesso!")
-                            
-                            st.download_button(
-                                label="💾 Download ZIP Rápido",
-                                data=zip_buffer.getvalue(),
-                                file_name=f"{st.session_state['nome_pasta']}_rapido.zip",
-                                mime="application/zip"
-                            )
-                            
-                        except Exception as e:
-                            st.error(f"❌ Erro ao criar ZIP: {str(e)}")
-                        finally:
-                            progress_bar.empty()
-                            status_text.empty()
+                    # O ZIP é montado no disco só no primeiro clique e reaproveitado nos reruns
+                    caminho_zip = zip_lote_pronto(diretorio_lote, st.session_state["processed_files"], comprimir=False)
+                    if caminho_zip is None and st.button("⚡ Download Rápido (ZIP sem compressão)"):
+                        caminho_zip = _montar_zip(diretorio_lote, st.session_state["processed_files"], comprimir=False)
+                        st.session_state["download_preparado"] = "zip_rapido"
+                    if caminho_zip:
+                        _download_sob_demanda(
+                            "⚡ Download Rápido (ZIP sem compressão)", caminho_zip,
+                            f"{st.session_state['nome_pasta']}_rapido.zip", "application/zip",
+                            key="zip_rapido", rotulo_download="💾 Download ZIP Rápido"
+                        )
             
             with col2:
                 # Download comprimido para arquivos maiores
                 if total_size_mb < 500:  # Limite de 500MB para ZIP
-                    import zipfile
-                    
-                    # Criar arquivo ZIP em memória com compressão otimizada
-                    zip_buffer = io.BytesIO()
-                    try:
-                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zip_file:
-                            total_files = len(st.session_state["processed_files"])
-                            
-                            for i, file_info in enumerate(st.session_state["processed_files"]):
-                                # Verificar se os dados do arquivo existem
-                                if 'dados' not in file_info or not file_info['dados']:
-                                    st.warning(f"⚠️ Arquivo {file_info['nome']} não possui dados válidos.")
-                                    continue
-                                
-                                # Adicionar arquivo ao ZIP
-                                zip_file.writestr(file_info['nome'], file_info['dados'])
-                        
-                        zip_buffer.seek(0)
-                        zip_data = zip_buffer.getvalue()
-                        
-                        if len(zip_data) > 0:
-                            # Botão de download do ZIP
-                            st.download_button(
-                                label="📦 Download de Todos os Arquivos (ZIP)",
-                                data=zip_data,
-                                file_name=f"{st.session_state['nome_pasta']}_processados.zip",
-                                mime="application/zip"
-                            )
-                        else:
-                            st.error("❌ Erro: ZIP vazio. Verifique se os arquivos foram processados corretamente.")
-                            
-                    except Exception as e:
-                        st.error(f"❌ Erro ao criar ZIP: {str(e)}")
-                        st.error(f"Detalhes do erro: {type(e).__name__}")
+                    # Montado uma vez por lote (chave: hash do conteúdo), depois só lido do disco
+                    caminho_zip = _montar_zip(diretorio_lote, st.session_state["processed_files"], comprimir=True)
+                    if caminho_zip:
+                        _download_sob_demanda(
+                            "📦 Download de Todos os Arquivos (ZIP)", caminho_zip,
+                            f"{st.session_state['nome_pasta']}_processados.zip", "application/zip",
+                            key="zip_processados", rotulo_download="💾 Baixar ZIP"
+                        )
                 else:
                     st.error("❌ Arquivo muito grande para download ZIP. Use download individual.")
             
             # Download individual de cada arquivo
             st.subheader("📄 Download Individual")
             for i, file_info in enumerate(st.session_state["processed_files"]):
-                file_size_mb = len(file_info['dados']) / (1024 * 1024)
+                file_size_mb = file_info['tamanho'] / (1024 * 1024)
                 
                 col1, col2, col3 = st.columns([2, 1, 1])
                 with col1:
@@ -599,13 +504,13 @@ def run_ai_pdf():
                     st.write(f"📏 {file_size_mb:.1f} MB")
                 
                 with col3:
-                    st.download_button(
-                        label="💾 Download",
-                        data=file_info['dados'],
-                        file_name=file_info['nome'],
-                        mime="application/pdf",
-                        key=f"download_{i}"
-                    )
+                    if parte_disponivel(file_info):
+                        _download_sob_demanda(
+                            "📥 Preparar", file_info['caminho'], file_info['nome'], "application/pdf",
+                            key=f"download_{i}"
+                        )
+                    else:
+                        st.warning("Arquivo removido do servidor")
             
             # Botões de limpeza
             col1, col2 = st.columns(2)
@@ -613,7 +518,9 @@ def run_ai_pdf():
             with col1:
                 # Botão para limpar arquivos processados da memória
                 if st.button("🗑️ Limpar Arquivos da Memória"):
-                    # Limpar arquivos da memória
+                    # Limpar arquivos da memória e do diretório do lote
+                    remover_lote(st.session_state.get("diretorio_lote"))
+                    st.session_state["diretorio_lote"] = None
                     st.session_state["processed_files"] = []
                     st.session_state["protocolo_atual"] = ""
                     st.session_state["nome_pasta"] = ""
@@ -624,9 +531,8 @@ def run_ai_pdf():
                     import gc
                     gc.collect()
                     
-                    # Limpar cache do Streamlit
+                    # Limpar cache do Streamlit (o cache_resource guarda o pool de conexões e fica)
                     st.cache_data.clear()
-                    st.cache_resource.clear()
                     
                     st.success("✅ Arquivos removidos da memória com sucesso!")
             
@@ -646,42 +552,18 @@ def run_ai_pdf():
             st.success("✅ **Arquivos processados com sucesso!**")
             
             # Calcular tamanho total dos arquivos
-            total_size = sum(len(file_info['dados']) for file_info in st.session_state["processed_files"])
+            total_size = sum(file_info['tamanho'] for file_info in st.session_state["processed_files"])
             total_size_mb = total_size / (1024 * 1024)
             
-            # Download ZIP simples
-            import zipfile
-            
-            # Criar ZIP em memória
-            zip_buffer = io.BytesIO()
-            try:
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zip_file:
-                    total_files = len(st.session_state["processed_files"])
-                    
-                    for i, file_info in enumerate(st.session_state["processed_files"]):
-                        # Verificar se os dados do arquivo existem
-                        if 'dados' not in file_info or not file_info['dados']:
-                            st.warning(f"⚠️ Arquivo {file_info['nome']} não possui dados válidos.")
-                            continue
-                        
-                        zip_file.writestr(file_info['nome'], file_info['dados'])
-                
-                zip_buffer.seek(0)
-                zip_data = zip_buffer.getvalue()
-                
-                if len(zip_data) > 0:
-                    st.download_button(
-                        label="📦 Download de Todos os Arquivos (ZIP)",
-                        data=zip_data,
-                        file_name=f"arquivos_processados.zip",
-                        mime="application/zip"
-                    )
-                else:
-                    st.error("❌ Erro: ZIP vazio. Verifique se os arquivos foram processados corretamente.")
-                    
-            except Exception as e:
-                st.error(f"❌ Erro ao criar ZIP: {str(e)}")
-                st.error(f"Detalhes do erro: {type(e).__name__}")
+            # Download ZIP simples, montado no disco uma vez por lote
+            diretorio_lote = st.session_state.get("diretorio_lote") or os.path.dirname(st.session_state["processed_files"][0]['caminho'])
+            caminho_zip = _montar_zip(diretorio_lote, st.session_state["processed_files"], comprimir=True)
+            if caminho_zip:
+                _download_sob_demanda(
+                    "📦 Download de Todos os Arquivos (ZIP)", caminho_zip,
+                    "arquivos_processados.zip", "application/zip",
+                    key="zip_simples", rotulo_download="💾 Baixar ZIP"
+                )
             
             # Download individual simples
             st.subheader("📄 Download Individual")
@@ -690,13 +572,13 @@ def run_ai_pdf():
                 with col1:
                     st.write(f"**{file_info['nome']}**")
                 with col2:
-                    st.download_button(
-                        label="💾 Download",
-                        data=file_info['dados'],
-                        file_name=file_info['nome'],
-                        mime="application/pdf",
-                        key=f"download_simple_{i}"
-                    )
+                    if parte_disponivel(file_info):
+                        _download_sob_demanda(
+                            "📥 Preparar", file_info['caminho'], file_info['nome'], "application/pdf",
+                            key=f"download_simple_{i}"
+                        )
+                    else:
+                        st.warning("Arquivo removido do servidor")
     
     else:
         # Quando não há arquivos processados
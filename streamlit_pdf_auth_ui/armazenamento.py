@@ -0,0 +1,138 @@
+import os
+import shutil
+import hashlib
+import zipfile
+from .config import obter_config
+
+# Diretório base dos lotes processados (um subdiretório por timestamp_pasta)
+DIRETORIO_BASE = obter_config("armazenamento", "diretorio") or "/app/processed_pdfs"
+
+
+def criar_estrutura_diretorios(timestamp_pasta):
+    """Cria (se preciso) e retorna o diretório do lote `timestamp_pasta`"""
+    if not timestamp_pasta:
+        raise ValueError("timestamp_pasta não definido")
+    diretorio = os.path.join(DIRETORIO_BASE, timestamp_pasta)
+    os.makedirs(diretorio, exist_ok=True)
+    return diretorio
+
+
+def _caminho_livre(diretorio, nome_arquivo):
+    """Evita sobrescrever outra parte do lote com o mesmo nome (ex.: guia repetida)"""
+    caminho = os.path.join(diretorio, nome_arquivo)
+    base, extensao = os.path.splitext(nome_arquivo)
+    contador = 2
+    while os.path.exists(caminho):
+        caminho = os.path.join(diretorio, f"{base}_{contador}{extensao}")
+        contador += 1
+    return caminho
+
+
+def salvar_parte_provisoria(diretorio, indice, idx, dados):
+    """Grava a parte `idx` do arquivo `indice` com um nome provisório e retorna o descritor dela.
+
+    Roda nos workers, para que os bytes das partes não voltem ao processo
+    principal. O nome definitivo é dado depois por `publicar_parte`. A
+    gravação passa por um arquivo temporário para que um download nunca
+    veja uma parte pela metade.
+    """
+    caminho = os.path.join(diretorio, f".parte_{indice:05d}_{idx:03d}.pdf")
+    temporario = caminho + ".tmp"
+    with open(temporario, "wb") as arquivo:
+        arquivo.write(dados)
+    os.replace(temporario, caminho)
+    return {
+        'caminho': caminho,
+        'tamanho': len(dados),
+        'sha256': hashlib.sha256(dados).hexdigest(),
+    }
+
+
+def publicar_parte(diretorio, provisoria, nome_arquivo, tipo, numero_guia):
+    """Renomeia uma parte provisória para o nome definitivo e retorna o descritor leve dela.
+
+    Chamada no processo principal, na ordem do upload: assim o sufixo de
+    colisão (guia repetida) não depende de qual worker terminou primeiro.
+    Só o descritor vai para o `st.session_state`; os bytes ficam no arquivo.
+    """
+    caminho = _caminho_livre(diretorio, nome_arquivo)
+    os.replace(provisoria['caminho'], caminho)
+    return {
+        'nome': os.path.basename(caminho),
+        'caminho': caminho,
+        'tamanho': provisoria['tamanho'],
+        'sha256': provisoria['sha256'],
+        'tipo': tipo,
+        'numero_guia': numero_guia,
+    }
+
+
+def descartar_partes(partes):
+    """Apaga do disco as partes listadas (provisórias ou não) que ainda existirem"""
+    for parte in partes:
+        try:
+            os.remove(parte['caminho'])
+        except FileNotFoundError:
+            pass
+
+
+def parte_disponivel(file_info):
+    """A parte ainda está no disco (a limpeza diária pode tê-la removido)"""
+    return os.path.isfile(file_info['caminho'])
+
+
+def remover_lote(diretorio):
+    """Apaga o diretório de um lote e tudo que há nele"""
+    if diretorio and os.path.abspath(diretorio).startswith(os.path.abspath(DIRETORIO_BASE) + os.sep):
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+
+def hash_lote(processed_files):
+    """Identifica o conteúdo do lote: nomes e hashes das partes, na ordem"""
+    hash_conteudo = hashlib.sha256()
+    for file_info in processed_files:
+        hash_conteudo.update(f"{file_info['nome']}\0{file_info['sha256']}\n".encode())
+    return hash_conteudo.hexdigest()
+
+
+def _caminho_zip(diretorio, processed_files, comprimir):
+    sufixo = "deflate" if comprimir else "stored"
+    return os.path.join(diretorio, f"lote_{hash_lote(processed_files)[:16]}_{sufixo}.zip")
+
+
+def zip_lote_pronto(diretorio, processed_files, comprimir=True):
+    """Caminho do ZIP do lote se ele já foi montado, senão None"""
+    caminho = _caminho_zip(diretorio, processed_files, comprimir)
+    return caminho if os.path.isfile(caminho) else None
+
+
+def montar_zip_lote(diretorio, processed_files, comprimir=True, progresso=None):
+    """Monta o ZIP do lote no disco uma única vez e retorna (caminho, ausentes).
+
+    O nome do arquivo leva o hash do conteúdo do lote, então reruns
+    reaproveitam o mesmo ZIP até o lote mudar. As partes são copiadas do
+    disco em blocos pelo zipfile, sem carregar o lote inteiro na memória.
+    `progresso(i, total, nome)` é chamado a cada parte adicionada.
+    `ausentes` lista as partes que não estavam mais no disco.
+    """
+    caminho = _caminho_zip(diretorio, processed_files, comprimir)
+    ausentes = [file_info['nome'] for file_info in processed_files if not parte_disponivel(file_info)]
+    if os.path.isfile(caminho):
+        return caminho, ausentes
+
+    temporario = caminho + ".tmp"
+    compressao = zipfile.ZIP_DEFLATED if comprimir else zipfile.ZIP_STORED
+    try:
+        with zipfile.ZipFile(temporario, 'w', compressao, compresslevel=6 if comprimir else None) as zip_file:
+            for i, file_info in enumerate(processed_files):
+                if file_info['nome'] in ausentes:
+                    continue
+                zip_file.write(file_info['caminho'], arcname=file_info['nome'])
+                if progresso:
+                    progresso(i + 1, len(processed_files), file_info['nome'])
+        os.replace(temporario, caminho)
+    except BaseException:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+    return caminho, ausentes
@@ -0,0 +1,182 @@
+import os
+import shutil
+import multiprocessing.util
+import tempfile
+import threading
+from collections import OrderedDict
+from PIL import Image
+from .config import obter_config
+
+
+class CacheRenderizacao:
+    """Cache LRU de páginas renderizadas, chave (hash do conteúdo, página, dpi).
+
+    Fica em dois níveis: memória, até `memoria_mb`, e disco, até `disco_mb`,
+    para onde vão as páginas despejadas da memória (pixels crus, sem
+    compressão, para reler rápido). Uma página pedida em DPI menor que uma
+    já em cache é derivada por redução da maior, sem chamar o poppler.
+    """
+
+    def __init__(self, memoria_mb, disco_mb, diretorio):
+        self.limite_memoria = memoria_mb * 1024 * 1024
+        self.limite_disco = disco_mb * 1024 * 1024
+        self.diretorio = diretorio
+        self._memoria = OrderedDict()  # chave -> imagem
+        self._disco = OrderedDict()    # chave -> (caminho, modo, tamanho, bytes)
+        self._uso_memoria = 0
+        self._uso_disco = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bytes_imagem(imagem):
+        return imagem.width * imagem.height * len(imagem.getbands())
+
+    def obter(self, sha256, pagina, dpi):
+        """Imagem da página em `dpi` ou None; deriva de um DPI maior se houver"""
+        with self._lock:
+            imagem = self._ler((sha256, pagina, dpi))
+            if imagem is not None:
+                return imagem
+
+            # Menor DPI acima do pedido: menos pixels para reduzir
+            maiores = sorted(
+                chave[2] for chave in list(self._memoria) + list(self._disco)
+                if chave[0] == sha256 and chave[1] == pagina and chave[2] > dpi
+            )
+            if not maiores:
+                return None
+            origem = self._ler((sha256, pagina, maiores[0]))
+        if origem is None:
+            return None
+
+        escala = dpi / maiores[0]
+        imagem = origem.resize(
+            (max(1, round(origem.width * escala)), max(1, round(origem.height * escala))), Image.LANCZOS
+        )
+        self.guardar(sha256, pagina, dpi, imagem)
+        return imagem
+
+    def guardar(self, sha256, pagina, dpi, imagem):
+        tamanho = self._bytes_imagem(imagem)
+        chave = (sha256, pagina, dpi)
+        if tamanho > self.limite_memoria:
+            # Maior que o orçamento de memória (ex.: 300 dpi com o orçamento
+            # dividido entre os workers): vai direto para o disco
+            with self._lock:
+                self._despejar_para_disco(chave, imagem)
+            return
+        with self._lock:
+            if chave in self._memoria:
+                self._memoria.move_to_end(chave)
+                return
+            self._memoria[chave] = imagem
+            self._uso_memoria += tamanho
+            while self._uso_memoria > self.limite_memoria:
+                chave_antiga, antiga = self._memoria.popitem(last=False)
+                self._uso_memoria -= self._bytes_imagem(antiga)
+                self._despejar_para_disco(chave_antiga, antiga)
+
+    def _ler(self, chave):
+        if chave in self._memoria:
+            self._memoria.move_to_end(chave)
+            return self._memoria[chave]
+        if chave in self._disco:
+            caminho, modo, tamanho, _ = self._disco[chave]
+            self._disco.move_to_end(chave)
+            with open(caminho, "rb") as arquivo:
+                return Image.frombytes(modo, tamanho, arquivo.read())
+        return None
+
+    def _despejar_para_disco(self, chave, imagem):
+        tamanho = self._bytes_imagem(imagem)
+        if self.limite_disco <= 0 or tamanho > self.limite_disco or chave in self._disco:
+            return
+        os.makedirs(self.diretorio, exist_ok=True)
+        caminho = os.path.join(self.diretorio, f"{chave[0]}_{chave[1]}_{chave[2]}.raw")
+        with open(caminho, "wb") as arquivo:
+            arquivo.write(imagem.tobytes())
+        self._disco[chave] = (caminho, imagem.mode, imagem.size, tamanho)
+        self._uso_disco += tamanho
+        while self._uso_disco > self.limite_disco:
+            _, (caminho_antigo, _, _, tamanho_antigo) = self._disco.popitem(last=False)
+            self._uso_disco -= tamanho_antigo
+            try:
+                os.remove(caminho_antigo)
+            except OSError:
+                pass
+
+    def descartar(self, sha256):
+        """Remove todas as páginas de um documento (fim do processamento dele)"""
+        with self._lock:
+            for chave in [c for c in self._memoria if c[0] == sha256]:
+                self._uso_memoria -= self._bytes_imagem(self._memoria.pop(chave))
+            for chave in [c for c in self._disco if c[0] == sha256]:
+                caminho, _, _, tamanho = self._disco.pop(chave)
+                self._uso_disco -= tamanho
+                try:
+                    os.remove(caminho)
+                except OSError:
+                    pass
+
+    def limpar(self):
+        with self._lock:
+            self._memoria.clear()
+            self._disco.clear()
+            self._uso_memoria = self._uso_disco = 0
+            shutil.rmtree(self.diretorio, ignore_errors=True)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+# Processos que dividem `memoria_mb`/`disco_mb` (ver dividir_orcamento_cache)
+_processos = 1
+
+
+def dividir_orcamento_cache(processos):
+    """Faz o cache deste processo usar 1/`processos` do orçamento configurado.
+
+    Chamado no inicializador dos workers do pool, antes do primeiro uso do
+    cache, para que o total não passe de `memoria_mb`/`disco_mb`.
+    """
+    global _processos
+    _processos = max(1, int(processos))
+
+
+def _pid_ativo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remover_orfaos(base):
+    """Apaga diretórios de processos que morreram sem limpar o cache (ex.: worker morto)"""
+    try:
+        nomes = os.listdir(base)
+    except OSError:
+        return
+    for nome in nomes:
+        if nome.isdigit() and int(nome) != os.getpid() and not _pid_ativo(int(nome)):
+            shutil.rmtree(os.path.join(base, nome), ignore_errors=True)
+
+
+def obter_cache():
+    """Cache de renderização do processo atual (cada worker tem o seu)"""
+    pid = os.getpid()
+    with _caches_lock:
+        if pid not in _caches:
+            base = obter_config("render_cache", "diretorio") or os.path.join(tempfile.gettempdir(), "render_cache")
+            _remover_orfaos(base)
+            cache = CacheRenderizacao(
+                memoria_mb=int(obter_config("render_cache", "memoria_mb", 256)) / _processos,
+                disco_mb=int(obter_config("render_cache", "disco_mb", 2048)) / _processos,
+                diretorio=os.path.join(base, str(pid)),
+            )
+            # Finalizador do multiprocessing em vez de atexit: roda também na
+            # saída dos workers do pool, onde os handlers do atexit não rodam
+            multiprocessing.util.Finalize(cache, cache.limpar, exitpriority=0)
+            _caches[pid] = cache
+        return _caches[pid]
@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+import streamlit as st
+
+
+def parametros_conexao(with_database=True):
+    connection_params = {
+        'host': os.getenv('POSTGRES_HOST', 'postgres'),
+        'user': os.getenv('POSTGRES_USER', 'postgres'),
+        'password': os.getenv('POSTGRES_PASSWORD', 'postgres'),
+        'port': 5432
+    }
+    if with_database:
+        connection_params['database'] = os.getenv('POSTGRES_DB', 'auth_db')
+    return connection_params
+
+
+class PoolConexoes:
+    """Pool de conexões Postgres compartilhado pelas threads do processo.
+
+    O ThreadedConnectionPool do psycopg2 falha na hora quando todas as
+    conexões estão em uso; aqui um semáforo faz a thread esperar até
+    `timeout` segundos por uma conexão livre. Conexões paradas há mais de
+    `ping` segundos são testadas com `SELECT 1` antes de serem entregues, e
+    conexões quebradas são descartadas em vez de voltar para o pool.
+    """
+
+    def __init__(self, minimo, maximo, timeout, ping, **parametros):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.timeout = timeout
+        self.ping = ping
+        self._pool = ThreadedConnectionPool(minimo, maximo, **parametros)
+        self._vagas = threading.BoundedSemaphore(maximo)
+        self._lock = threading.Lock()
+        self._ultimo_uso = {}  # id(conexão) -> time.monotonic() da devolução
+        self._stats = {
+            'checkouts': 0,
+            'em_uso': 0,
+            'pico_em_uso': 0,
+            'espera_total_ms': 0.0,
+            'espera_max_ms': 0.0,
+            'timeouts': 0,
+            'descartadas': 0,
+        }
+
+    def _saudavel(self, conn):
+        if conn.closed:
+            return False
+        parada_desde = self._ultimo_uso.get(id(conn))
+        if parada_desde is None or time.monotonic() - parada_desde < self.ping:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _obter_conexao(self):
+        # Cada conexão quebrada é trocada por uma nova; o limite evita laço infinito
+        for _ in range(self.maximo + 1):
+            conn = self._pool.getconn()
+            if self._saudavel(conn):
+                return conn
+            self._descartar(conn)
+        raise PoolError("Não foi possível obter uma conexão saudável com o banco")
+
+    def _descartar(self, conn):
+        self._ultimo_uso.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+        with self._lock:
+            self._stats['descartadas'] += 1
+
+    @contextmanager
+    def conexao(self):
+        """Empresta uma conexão do pool: `with pool.conexao() as conn: ...`
+
+        Transações deixadas abertas são desfeitas na devolução.
+        """
+        inicio = time.monotonic()
+        if not self._vagas.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PoolError(f"Nenhuma conexão livre no pool após {self.timeout}s")
+        espera_ms = (time.monotonic() - inicio) * 1000
+        try:
+            conn = self._obter_conexao()
+        except BaseException:
+            self._vagas.release()
+            raise
+
+        with self._lock:
+            stats = self._stats
+            stats['checkouts'] += 1
+            stats['em_uso'] += 1
+            stats['pico_em_uso'] = max(stats['pico_em_uso'], stats['em_uso'])
+            stats['espera_total_ms'] += espera_ms
+            stats['espera_max_ms'] = max(stats['espera_max_ms'], espera_ms)
+
+        quebrada = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            quebrada = True
+            raise
+        finally:
+            if quebrada or conn.closed:
+                self._descartar(conn)
+            else:
+                self._ultimo_uso[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)  # Faz rollback se a transação ficou aberta
+            with self._lock:
+                self._stats['em_uso'] -= 1
+            self._vagas.release()
+
+    def estatisticas(self):
+        """Uso e espera do pool desde o início do processo"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['minimo'] = self.minimo
+        stats['maximo'] = self.maximo
+        stats['espera_media_ms'] = stats['espera_total_ms'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    def fechar(self):
+        self._pool.closeall()
+
+
+@st.cache_resource(show_spinner=False)
+def obter_pool():
+    """Pool único do processo, compartilhado por todas as sessões do Streamlit.
+
+    Tamanhos vêm de POSTGRES_POOL_MIN / POSTGRES_POOL_MAX, espera máxima por
+    conexão de POSTGRES_POOL_TIMEOUT e intervalo do health check de
+    POSTGRES_POOL_PING (segundos).
+    """
+    return PoolConexoes(
+        minimo=int(os.getenv('POSTGRES_POOL_MIN', '1')),
+        maximo=int(os.getenv('POSTGRES_POOL_MAX', '10')),
+        timeout=float(os.getenv('POSTGRES_POOL_TIMEOUT', '10')),
+        ping=float(os.getenv('POSTGRES_POOL_PING', '30')),
+        **parametros_conexao()
+    )
+
+
+def conexao():
+    """Atalho para `obter_pool().conexao()`"""
+    return obter_pool().conexao()
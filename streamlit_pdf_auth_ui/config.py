@@ -0,0 +1,18 @@
+import os
+from functools import lru_cache
+import yaml
+from yaml.loader import SafeLoader
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../config.yml')
+
+
+@lru_cache(maxsize=None)
+def carregar_config():
+    """Carrega o config.yml uma única vez por processo"""
+    with open(CONFIG_PATH) as file:
+        return yaml.load(file, Loader=SafeLoader) or {}
+
+
+def obter_config(secao: str, chave: str, padrao=None):
+    """Lê `secao.chave` do config.yml, retornando `padrao` se ausente"""
+    return (carregar_config().get(secao) or {}).get(chave, padrao)
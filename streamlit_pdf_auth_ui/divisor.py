@@ -0,0 +1,457 @@
+import io
+import os
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageChops, ImageStat, features
+from .config import obter_config
+from .cache_renderizacao import obter_cache
+from .paginas import contar_paginas, renderizar_em_blocos, renderizar_pagina, hash_documento
+from .preprocessamento import limiar_otsu, para_cinza
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    from pymupdf import fitz  # PyMuPDF
+
+# Estimativa fixa para o dicionário da página e entradas de xref
+_OVERHEAD_PAGINA = 1024
+
+
+def _tamanho_stream(doc, xref):
+    """Tamanho do stream de um objeto lido do /Length, sem decodificar"""
+    tipo, valor = doc.xref_get_key(xref, "Length")
+    try:
+        if tipo == "xref":
+            # /Length indireto: "12 0 R"
+            return int(doc.xref_object(int(valor.split()[0])).strip())
+        if tipo == "int":
+            return int(valor)
+    except ValueError:
+        pass
+    return len(doc.xref_stream_raw(xref) or b"")
+
+
+def _xrefs_pagina(doc, indice):
+    """Objetos com stream usados pela página: conteúdo, imagens e fontes"""
+    page = doc.load_page(indice)
+    xrefs = set(page.get_contents())
+    xrefs.update(img[0] for img in page.get_images(full=True))
+    xrefs.update(font[0] for font in page.get_fonts(full=True) if font[0])
+    return xrefs
+
+
+def _pagina_monocromatica(imagem):
+    """Detecta páginas de formulário preto e branco numa miniatura: quase
+    todos os pixels perto do preto ou do branco e sem cor significativa."""
+    miniatura = imagem.reduce(max(1, min(imagem.size) // 256))
+    if miniatura.mode == "RGB":
+        r, g, b = miniatura.split()
+        saturacao = ImageStat.Stat(ImageChops.difference(r, g)).mean[0] + ImageStat.Stat(ImageChops.difference(g, b)).mean[0]
+        if saturacao > float(obter_config("divisao", "max_diferenca_cor", 8)):
+            return False
+    histograma = para_cinza(miniatura).histogram()
+    extremos = sum(histograma[:64]) + sum(histograma[192:])
+    return extremos / max(1, sum(histograma)) >= float(obter_config("divisao", "limiar_monocromatico", 0.95))
+
+
+def _codificar_pagina(imagem, qualidade):
+    """Codifica a página como PDF de uma página.
+
+    Páginas monocromáticas viram imagem de 1 bit, que o Pillow grava com
+    CCITT Group 4 (via libtiff); fotos e páginas coloridas seguem em JPEG.
+    """
+    buffer = io.BytesIO()
+    if obter_config("divisao", "bilevel", True) and features.check("libtiff") and _pagina_monocromatica(imagem):
+        cinza = para_cinza(imagem)
+        limiar = limiar_otsu(cinza.histogram())
+        bilevel = cinza.point([0] * limiar + [255] * (256 - limiar)).convert("1", dither=Image.Dither.NONE)
+        bilevel.save(buffer, format="PDF")
+    else:
+        imagem.save(buffer, format="PDF", quality=qualidade)
+    return buffer.getvalue()
+
+
+def _rasterizar_pagina(pdf_bytes, indice, limite_bytes, sha256, dpi_inicial=300, dpi_min=100, qualidade_jpeg=95):
+    """Último recurso para uma página que sozinha passa do limite: rasteriza
+    só ela, reduzindo DPI/qualidade até caber. Retorna um PDF de uma página."""
+    dpi_atual = dpi_inicial
+    qualidade_atual = qualidade_jpeg
+    while dpi_atual >= dpi_min:
+        imagem = renderizar_pagina(pdf_bytes, indice, dpi_atual, sha256)
+        pagina_pdf = _codificar_pagina(imagem, qualidade_atual)
+        if len(pagina_pdf) <= limite_bytes:
+            return pagina_pdf
+        dpi_atual -= 50
+        qualidade_atual = max(50, qualidade_atual - 10)
+    raise ValueError(f"A página {indice + 1} não cabe em uma parte, mesmo com qualidade reduzida.")
+
+
+def _gerar_faixa(src, inicio, fim, limite_bytes):
+    """Gera o PDF da faixa; se a estimativa errou e passou do limite, divide ao meio"""
+    parte = fitz.open()
+    parte.insert_pdf(src, from_page=inicio, to_page=fim)
+    dados = parte.tobytes(garbage=3, deflate=True)
+    parte.close()
+    if len(dados) <= limite_bytes or inicio == fim:
+        yield dados
+        return
+    del dados
+    meio = (inicio + fim) // 2
+    yield from _gerar_faixa(src, inicio, meio, limite_bytes)
+    yield from _gerar_faixa(src, meio + 1, fim, limite_bytes)
+
+
+def dividir_por_paginas(pdf_bytes, max_mb=200, sha256=None):
+    """
+    Divide o PDF em faixas de páginas com PyMuPDF (`insert_pdf`), copiando
+    os streams originais sem re-codificar e sem perder qualidade.
+    O tamanho de cada parte é estimado pelos streams (conteúdo, imagens e
+    fontes) de cada página, contando uma única vez os recursos compartilhados.
+    Só rasteriza páginas que sozinhas passam de `max_mb`.
+    Gerador: cada parte sai assim que é montada.
+    """
+    limite_bytes = max_mb * 1024 * 1024
+    sha256 = sha256 or hash_documento(pdf_bytes)
+    src = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        # Agrupa páginas em faixas pelo tamanho estimado
+        faixas = []  # (inicio, fim) ou ("raster", indice)
+        inicio, tamanho_atual, xrefs_parte = None, 0, set()
+        for indice in range(src.page_count):
+            xrefs = _xrefs_pagina(src, indice)
+            tamanho_proprio = _OVERHEAD_PAGINA + sum(_tamanho_stream(src, x) for x in xrefs)
+            tamanho_novo = _OVERHEAD_PAGINA + sum(_tamanho_stream(src, x) for x in xrefs - xrefs_parte)
+
+            if tamanho_proprio > limite_bytes:
+                if inicio is not None:
+                    faixas.append((inicio, indice - 1))
+                faixas.append(("raster", indice))
+                inicio, tamanho_atual, xrefs_parte = None, 0, set()
+            elif inicio is not None and tamanho_atual + tamanho_novo > limite_bytes:
+                faixas.append((inicio, indice - 1))
+                inicio, tamanho_atual, xrefs_parte = indice, tamanho_proprio, set(xrefs)
+            else:
+                if inicio is None:
+                    inicio = indice
+                tamanho_atual += tamanho_novo
+                xrefs_parte |= xrefs
+        if inicio is not None:
+            faixas.append((inicio, src.page_count - 1))
+
+        for faixa in faixas:
+            if faixa[0] == "raster":
+                yield _rasterizar_pagina(pdf_bytes, faixa[1], limite_bytes, sha256)
+            else:
+                yield from _gerar_faixa(src, faixa[0], faixa[1], limite_bytes)
+    finally:
+        src.close()
+
+
+# Degraus de DPI avaliados pelo planejador e páginas usadas na amostra
+_PASSO_DPI = 25
+_PAGINAS_AMOSTRA = 5
+# Folga para o empacotamento guloso das páginas nas partes
+_FOLGA_EMPACOTAMENTO = 0.9
+
+
+def _candidatos_qualidade(dpi_inicial, dpi_min, qualidade_jpeg):
+    """(dpi, qualidade) do melhor para o pior; a qualidade cai 10 a cada 50 dpi"""
+    candidatos = []
+    dpi = dpi_inicial
+    while dpi >= dpi_min:
+        qualidade = max(50, qualidade_jpeg - int((dpi_inicial - dpi) / 50 * 10))
+        candidatos.append((dpi, qualidade))
+        dpi -= _PASSO_DPI
+    return candidatos
+
+
+def _tamanho_codificado(imagem, qualidade):
+    return len(_codificar_pagina(imagem, qualidade))
+
+
+def _threads_codificacao():
+    """Threads para codificar páginas (os codificadores do Pillow liberam o GIL)"""
+    threads = obter_config("divisao", "threads_codificacao")
+    return max(1, int(threads)) if threads else min(4, os.cpu_count() or 1)
+
+
+def _estimar_tamanhos(pdf_bytes, candidatos, sha256):
+    """
+    Estima o tamanho total (bytes) do documento rasterizado em cada candidato
+    (dpi, qualidade); None quando não há o que estimar.
+
+    Renderiza só uma amostra de páginas uma vez, no maior DPI, mede o tamanho
+    codificado em até três candidatos (reduzindo a imagem em vez de
+    re-renderizar) e interpola log(tamanho) x log(dpi) para os demais.
+    """
+    total_paginas = contar_paginas(pdf_bytes)
+    if total_paginas == 0 or len(candidatos) == 1:
+        return None
+    passo = max(1, total_paginas // _PAGINAS_AMOSTRA)
+    amostra_indices = list(range(0, total_paginas, passo))[:_PAGINAS_AMOSTRA]
+
+    dpi_max = candidatos[0][0]
+    amostra = [
+        renderizar_pagina(pdf_bytes, i, dpi_max, sha256)
+        for i in amostra_indices
+    ]
+
+    # Medições em três pontos da escada: melhor, intermediário e pior
+    medidos = sorted({0, len(candidatos) // 2, len(candidatos) - 1})
+    def medir(indice_e_imagem):
+        indice, imagem = indice_e_imagem
+        dpi, qualidade = candidatos[indice]
+        escala = dpi / dpi_max
+        reduzida = imagem if escala == 1 else imagem.resize(
+            (max(1, int(imagem.width * escala)), max(1, int(imagem.height * escala))), Image.LANCZOS
+        )
+        return indice, _tamanho_codificado(reduzida, qualidade)
+
+    tamanhos = {indice: [] for indice in medidos}
+    with ThreadPoolExecutor(max_workers=_threads_codificacao()) as executor:
+        for indice, tamanho in executor.map(medir, [(i, img) for i in medidos for img in amostra]):
+            tamanhos[indice].append(tamanho)
+    # (log dpi, log bytes por página)
+    pontos = sorted(
+        (math.log(candidatos[indice][0]), math.log(sum(medidas) / len(medidas)))
+        for indice, medidas in tamanhos.items()
+    )
+
+    return [math.exp(_interpolar(pontos, math.log(dpi))) * total_paginas for dpi, _ in candidatos]
+
+
+def _planejar_qualidade(estimados, limite_bytes, inicio=0):
+    """Índice do primeiro candidato a partir de `inicio` cujo tamanho estimado
+    cabe em `limite_bytes` (o último se nenhum couber; `inicio` se já passou do fim)"""
+    if estimados is None:
+        return inicio
+    for indice in range(inicio, len(estimados)):
+        if estimados[indice] <= limite_bytes:
+            return indice
+    return max(inicio, len(estimados) - 1)
+
+
+def _interpolar(pontos, x):
+    """Interpolação linear por partes (extrapola pelos segmentos das pontas)"""
+    if len(pontos) == 1:
+        return pontos[0][1]
+    for (x0, y0), (x1, y1) in zip(pontos, pontos[1:]):
+        if x <= x1 or (x1, y1) == pontos[-1]:
+            return y0 + (y1 - y0) * (x - x0) / (x1 - x0) if x1 != x0 else y0
+    return pontos[-1][1]
+
+
+def _juntar_paginas(paginas_pdf):
+    """Junta PDFs de uma página já codificados em um só, sem re-codificar"""
+    parte = fitz.open()
+    for pagina_pdf in paginas_pdf:
+        with fitz.open(stream=pagina_pdf, filetype="pdf") as pagina:
+            parte.insert_pdf(pagina)
+    dados = parte.tobytes(garbage=1)
+    parte.close()
+    return dados
+
+
+def _montar_partes_raster(pdf_bytes, dpi_atual, qualidade_atual, max_mb, sha256):
+    """Rasteriza o documento e agrupa as páginas em partes de até `max_mb`.
+
+    As páginas chegam de um gerador em blocos e cada uma é codificada uma
+    única vez, em paralelo num pool de threads, como um PDF de uma página
+    independente; as partes são montadas juntando esses PDFs sem
+    re-codificar. Só os bytes codificados ficam em memória até a parte
+    fechar, e no máximo 2x threads imagens aguardam codificação.
+    Gerador: cada parte sai assim que fecha.
+    """
+    paginas_por_bloco = int(obter_config("divisao", "paginas_por_bloco", 8))
+    threads = _threads_codificacao()
+    paginas_atual = []
+    tamanho_atual = 0
+
+    def codificadas():
+        # Janela deslizante: mantém a ordem das páginas e limita as imagens em espera
+        pendentes = deque()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for imagem in renderizar_em_blocos(pdf_bytes, dpi_atual, paginas_por_bloco, sha256):
+                pendentes.append(executor.submit(_codificar_pagina, imagem, qualidade_atual))
+                del imagem
+                if len(pendentes) >= threads * 2:
+                    yield pendentes.popleft().result()
+            while pendentes:
+                yield pendentes.popleft().result()
+
+    for pagina_pdf in codificadas():
+        tamanho_pagina = len(pagina_pdf)
+
+        if (tamanho_atual + tamanho_pagina) > (max_mb * 1024 * 1024):
+            if paginas_atual:
+                yield _juntar_paginas(paginas_atual)
+
+            paginas_atual = [pagina_pdf]
+            tamanho_atual = tamanho_pagina
+        else:
+            paginas_atual.append(pagina_pdf)
+            tamanho_atual += tamanho_pagina
+
+    # Salvar a última parte
+    if paginas_atual:
+        yield _juntar_paginas(paginas_atual)
+
+
+def _imagem_para_pil(doc, xref):
+    """Decodifica a imagem embutida com PyMuPDF e devolve em L ou RGB"""
+    pix = fitz.Pixmap(doc, xref)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    modo = "L" if pix.n == 1 else "RGB"
+    return Image.frombytes(modo, (pix.width, pix.height), pix.samples)
+
+
+def compactar_imagens(pdf_bytes, dpi_alvo=200, qualidade=85):
+    """
+    Reduz e recomprime só as imagens embutidas (XObjects) acima de `dpi_alvo`,
+    mantendo texto, vetores e a estrutura do PDF. A resolução efetiva de cada
+    imagem vem da matriz com que ela é desenhada na página. Imagens de 1 bit
+    e com transparência (SMask) são mantidas como estão.
+    Salva com coleta de lixo e deflate dos streams.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        processados = set()
+        for page in doc:
+            for img in page.get_images(full=True):
+                xref, smask, largura, altura, bpc = img[0], img[1], img[2], img[3], img[4]
+                if xref in processados or smask or bpc == 1:
+                    continue
+                processados.add(xref)
+
+                # A matriz leva o quadrado unitário da imagem à página: os
+                # comprimentos dos seus eixos valem com a imagem rotacionada
+                dpis = []
+                for _, matriz in page.get_image_rects(xref, transform=True):
+                    largura_pt = math.hypot(matriz.a, matriz.b)
+                    altura_pt = math.hypot(matriz.c, matriz.d)
+                    if largura_pt > 0 and altura_pt > 0:
+                        dpis.append(min(largura / (largura_pt / 72), altura / (altura_pt / 72)))
+                if not dpis:
+                    continue
+                # Pixels por polegada no maior tamanho em que a imagem aparece
+                dpi_efetivo = min(dpis)
+                if dpi_efetivo <= dpi_alvo * 1.1:
+                    continue
+
+                imagem = _imagem_para_pil(doc, xref)
+                escala = dpi_alvo / dpi_efetivo
+                reduzida = imagem.resize(
+                    (max(1, int(largura * escala)), max(1, int(altura * escala))), Image.LANCZOS
+                )
+                buffer = io.BytesIO()
+                reduzida.save(buffer, format="JPEG", quality=qualidade, optimize=True)
+                page.replace_image(xref, stream=buffer.getvalue())
+
+        return doc.tobytes(garbage=4, deflate=True)
+    finally:
+        doc.close()
+
+
+def _entregar(partes, max_partes, gravar, descartar, medir=False):
+    """Consome as partes de uma tentativa, entregando cada uma a `gravar` assim que sai.
+
+    Retorna (entregues, total_bytes). Se a tentativa passar de `max_partes`,
+    as já entregues vão para `descartar` e `entregues` volta None; com
+    `medir` o resto ainda é gerado só para somar o tamanho. Em caso de
+    exceção as entregues também são descartadas.
+    """
+    entregues, total = [], 0
+    try:
+        for parte in partes:
+            total += len(parte)
+            if entregues is None:
+                continue
+            if len(entregues) < max_partes:
+                entregues.append(gravar(len(entregues), parte))
+                continue
+            descartar(entregues)
+            entregues = None
+            if not medir:
+                break
+    except BaseException:
+        if entregues:
+            descartar(entregues)
+        raise
+    finally:
+        partes.close()
+    return entregues, total
+
+
+def reduzir_ou_dividir_pdf(pdf_bytes, max_mb=200, max_partes=10, dpi_inicial=300, dpi_min=100, qualidade_jpeg=95, sha256=None,
+                           gravar=None, descartar=None):
+    """
+    Divide o PDF em partes de até `max_mb` MB (padrão: 200MB).
+    Gera apenas o número necessário de partes, com máximo de `max_partes`.
+    Primeiro tenta a divisão estrutural por faixas de páginas (sem
+    re-rasterizar); se passar de `max_partes`, recomprime só as imagens
+    embutidas e divide de novo; só rasteriza o documento como último recurso.
+    Renderizações passam pelo cache compartilhado com o OCR (chave `sha256`).
+
+    Com `gravar(idx, dados)` cada parte é entregue assim que produzida, sem
+    acumular os bytes do documento todo, e o retorno é a lista do que
+    `gravar` devolveu; `descartar(entregues)` desfaz uma tentativa que
+    passou de `max_partes`. Sem `gravar`, retorna os bytes das partes.
+    """
+    sha256 = sha256 or hash_documento(pdf_bytes)
+    if gravar is None:
+        gravar, descartar = (lambda idx, dados: dados), (lambda entregues: None)
+    try:
+        entregues, _ = _entregar(dividir_por_paginas(pdf_bytes, max_mb=max_mb, sha256=sha256),
+                                 max_partes, gravar, descartar)
+        if entregues is not None:
+            return entregues
+    except (ValueError, RuntimeError) as e:
+        # PDF que o PyMuPDF não consegue dividir: segue para a rasterização
+        print(f"⚠️ Divisão estrutural falhou ({e}), rasterizando o PDF")
+    else:
+        if obter_config("divisao", "compactacao", True):
+            try:
+                compactado = compactar_imagens(
+                    pdf_bytes,
+                    dpi_alvo=int(obter_config("divisao", "dpi_compactacao", 200)),
+                    qualidade=int(obter_config("divisao", "qualidade_compactacao", 85)),
+                )
+                # Páginas do documento compactado que a divisão rasterizar são
+                # descartadas aqui; as do original ficam para quem chamou
+                sha256_compactado = hash_documento(compactado)
+                try:
+                    entregues, _ = _entregar(dividir_por_paginas(compactado, max_mb=max_mb, sha256=sha256_compactado),
+                                             max_partes, gravar, descartar)
+                finally:
+                    obter_cache().descartar(sha256_compactado)
+                if entregues is not None:
+                    return entregues
+            except (ValueError, RuntimeError) as e:
+                print(f"⚠️ Compactação das imagens falhou ({e}), rasterizando o PDF")
+
+    # Planeja DPI/qualidade por amostragem em vez de re-renderizar o documento a cada tentativa
+    candidatos = _candidatos_qualidade(dpi_inicial, dpi_min, qualidade_jpeg)
+    limite_bytes = max_mb * max_partes * 1024 * 1024 * _FOLGA_EMPACOTAMENTO
+    estimados = _estimar_tamanhos(pdf_bytes, candidatos, sha256)
+    indice = _planejar_qualidade(estimados, limite_bytes)
+
+    while indice < len(candidatos):
+        dpi_atual, qualidade_atual = candidatos[indice]
+        entregues, medido = _entregar(_montar_partes_raster(pdf_bytes, dpi_atual, qualidade_atual, max_mb, sha256),
+                                      max_partes, gravar, descartar, medir=estimados is not None)
+
+        # ✅ Aqui está o controle correto: só retorna se o número de partes está dentro do limite
+        if entregues is not None:
+            return entregues
+        # O modelo subestimou: corrige as estimativas pelo tamanho medido neste
+        # degrau e salta direto para o primeiro que passa a caber
+        if estimados is not None:
+            fator = medido / estimados[indice]
+            estimados = [estimado * fator for estimado in estimados]
+        indice = _planejar_qualidade(estimados, limite_bytes, indice + 1)
+
+    # Se não foi possível dividir com qualidade reduzida
+    raise ValueError(f"Não foi possível dividir o PDF em até {max_partes} partes de {max_mb}MB, mesmo com qualidade reduzida.")
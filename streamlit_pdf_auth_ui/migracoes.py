@@ -0,0 +1,187 @@
+import uuid
+import threading
+import yaml
+from argon2 import PasswordHasher
+from .conexoes import conexao
+
+# Chave do advisory lock que serializa as migrações entre processos/réplicas
+_CHAVE_LOCK = 7301202401
+
+# (versão, descrição, comandos). Nunca altere uma migração já publicada:
+# acrescente uma nova com a próxima versão. Os comandos usam IF NOT EXISTS
+# para que bancos criados antes do schema_version sejam adotados sem erro.
+MIGRACOES = [
+    (1, "tabelas de usuários e tipos", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_types (
+            id VARCHAR(36) PRIMARY KEY,
+            type_name VARCHAR(255) UNIQUE NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id VARCHAR(36) PRIMARY KEY,
+            username VARCHAR(255) UNIQUE NOT NULL,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            user_type_id VARCHAR(36),
+            FOREIGN KEY (user_type_id) REFERENCES user_types(id)
+        )
+        ''',
+    ]),
+    # Cache de resultados de OCR, indexado pelo SHA-256 do PDF enviado
+    (2, "cache de OCR", [
+        '''
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            sha256 CHAR(64) PRIMARY KEY,
+            numero_guia VARCHAR(64),
+            total_paginas INTEGER NOT NULL,
+            metodo VARCHAR(16),
+            pagina INTEGER,
+            dpi INTEGER,
+            angulo INTEGER,
+            variante VARCHAR(32),
+            duracao_ms INTEGER,
+            criado_em TIMESTAMP NOT NULL DEFAULT NOW(),
+            ultimo_acesso TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS ocr_cache_ultimo_acesso_idx ON ocr_cache (ultimo_acesso)',
+    ]),
+    # Revogação dos tokens de sessão assinados (logout, troca de senha)
+    (3, "sessões revogadas", [
+        '''
+        CREATE TABLE IF NOT EXISTS sessoes_revogadas (
+            tipo VARCHAR(16) NOT NULL,
+            valor VARCHAR(255) NOT NULL,
+            revogado_em BIGINT NOT NULL,
+            expira_em BIGINT NOT NULL,
+            PRIMARY KEY (tipo, valor)
+        )
+        ''',
+    ]),
+    # Busca por substring nas telas de administração. Sem permissão para criar
+    # o pg_trgm a migração segue; o ILIKE funciona, só que sem índice.
+    (4, "índices trigram para busca de usuários e tipos", [
+        '''
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN insufficient_privilege THEN
+            RAISE NOTICE 'pg_trgm indisponível; busca sem índice trigram';
+        END
+        $$
+        ''',
+        '''
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS users_username_trgm_idx ON users USING gin (username gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS user_types_type_name_trgm_idx ON user_types USING gin (type_name gin_trgm_ops);
+            END IF;
+        END
+        $$
+        ''',
+        # Join do tipo na listagem paginada
+        'CREATE INDEX IF NOT EXISTS users_user_type_id_idx ON users (user_type_id)',
+    ]),
+]
+
+
+def _versao_atual(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            versao INTEGER PRIMARY KEY,
+            descricao TEXT NOT NULL,
+            aplicada_em TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    ''')
+    cursor.execute('SELECT COALESCE(MAX(versao), 0) FROM schema_version')
+    return cursor.fetchone()[0]
+
+
+def _semear_usuarios(cursor, caminho='users_config.yml'):
+    """Cria os tipos e usuários do YAML que ainda não existem.
+
+    Só os usuários ausentes têm a senha passada pelo Argon2; os inserts são
+    feitos em lote com ON CONFLICT DO NOTHING.
+    """
+    with open(caminho, 'r') as file:
+        users = list(yaml.safe_load(file)['users'].values())
+
+    tipos = sorted({user_info['type'] for user_info in users})
+    cursor.execute('''
+        INSERT INTO user_types (id, type_name)
+        SELECT * FROM unnest(%s::varchar[], %s::varchar[])
+        ON CONFLICT (type_name) DO NOTHING
+    ''', ([str(uuid.uuid4()) for _ in tipos], tipos))
+
+    cursor.execute('''
+        SELECT username FROM unnest(%s::varchar[]) AS novo(username)
+        WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.username = novo.username)
+    ''', ([user_info['username'] for user_info in users],))
+    ausentes = {row[0] for row in cursor.fetchall()}
+    novos = [user_info for user_info in users if user_info['username'] in ausentes]
+    if not novos:
+        return 0
+
+    ph = PasswordHasher()
+    cursor.execute('''
+        INSERT INTO users (id, username, email, password, user_type_id)
+        SELECT novo.id, novo.username, novo.email, novo.password, ut.id
+        FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::text[], %s::varchar[])
+             AS novo(id, username, email, password, type_name)
+        JOIN user_types ut ON ut.type_name = novo.type_name
+        ON CONFLICT DO NOTHING
+    ''', (
+        [str(uuid.uuid4()) for _ in novos],
+        [user_info['username'] for user_info in novos],
+        [user_info['email'] for user_info in novos],
+        [ph.hash(user_info['password']) for user_info in novos],
+        [user_info['type'] for user_info in novos],
+    ))
+    return cursor.rowcount
+
+
+def migrar():
+    """Aplica as migrações pendentes e semeia os usuários, numa única transação.
+
+    O advisory lock garante que só um processo migra por vez; os demais
+    esperam e encontram o schema já na versão final.
+    """
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (_CHAVE_LOCK,))
+            versao = _versao_atual(cursor)
+            for numero, descricao, comandos in MIGRACOES:
+                if numero <= versao:
+                    continue
+                for comando in comandos:
+                    cursor.execute(comando)
+                cursor.execute('INSERT INTO schema_version (versao, descricao) VALUES (%s, %s)', (numero, descricao))
+                print(f"Migração {numero} aplicada: {descricao}")
+            criados = _semear_usuarios(cursor)
+            if criados:
+                print(f"{criados} usuário(s) inicial(is) criado(s).")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+_migrado = False
+_lock = threading.Lock()
+
+
+def migrar_uma_vez():
+    """Roda `migrar()` só na primeira chamada do processo; reruns do Streamlit não pagam nada.
+
+    Em caso de falha a próxima chamada tenta de novo.
+    """
+    global _migrado
+    if _migrado:
+        return
+    with _lock:
+        if not _migrado:
+            migrar()
+            _migrado = True
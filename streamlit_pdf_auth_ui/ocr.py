@@ -0,0 +1,279 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image
+from .config import obter_config
+from .ocr_backend import obter_backend
+from .paginas import FontePaginas, ler_camada_texto
+from .preprocessamento import preprocess_variants, para_cinza
+
+# Ordem padrão da força bruta (graus, sentido anti-horário como em Image.rotate)
+ANGULOS = [0, 90, -90, 180]
+
+# Pool de threads do modo corrida, um por processo (ver _obter_pool)
+_pool_corrida = {'pid': None, 'pool': None}
+_pool_lock = threading.Lock()
+
+# Rotações sem perda para múltiplos de 90°
+_TRANSPOSICOES = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
+
+
+def extract_card_number(text):
+    pattern = r"(?:Nº|No|Número|Guia)\s*(?:Guia)?\s*(?:no|nº|número)?\s*Prestador[:\s]*([0-9]{6,})"
+    match = re.search(pattern, text, re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+def rotacionar(imagem, angulo):
+    """Rotaciona no sentido anti-horário; múltiplos de 90° usam transpose (sem perda)"""
+    angulo = angulo % 360
+    if angulo == 0:
+        return imagem
+    if angulo in _TRANSPOSICOES:
+        return imagem.transpose(_TRANSPOSICOES[angulo])
+    return imagem.rotate(angulo, expand=True)
+
+
+def detectar_orientacao(imagem):
+    """Detecta a orientação da página com um único passe OSD do Tesseract.
+
+    Retorna (angulo, confianca), onde `angulo` é a rotação anti-horária que
+    endireita a página. Em caso de falha (ex.: pouco texto) retorna (0, 0.0).
+    """
+    return obter_backend().orientacao(para_cinza(imagem))
+
+
+def _ocr_texto(imagem, regiao="pagina", parar=None):
+    """OCR das variantes binarizadas até encontrar o número da guia.
+
+    Retorna (numero, variante, regiao) ou (None, None, None). Se o evento
+    `parar` for sinalizado (outra tentativa já achou), desiste entre variantes.
+    """
+    backend = obter_backend()
+    for nome, variant in preprocess_variants(imagem):
+        if parar is not None and parar.is_set():
+            break
+        text = backend.texto(variant)
+        numero = extract_card_number(text)
+        if numero:
+            return numero, nome, regiao
+    return None, None, None
+
+
+def _localizar_ancora(imagem, escala):
+    """Procura a palavra "Prestador" com localização de palavras numa cópia reduzida.
+
+    Retorna a caixa (left, top, right, bottom) em coordenadas da imagem
+    original, ou None se a âncora não for encontrada.
+    """
+    largura, altura = imagem.size
+    reduzida = para_cinza(imagem).resize(
+        (max(1, int(largura * escala)), max(1, int(altura * escala)))
+    )
+    for palavra, caixa in obter_backend().palavras(reduzida):
+        if "prestador" in palavra.lower():
+            return tuple(int(coordenada / escala) for coordenada in caixa)
+    return None
+
+
+def _ocr_roi(imagem, parar=None):
+    """Lê apenas a região do campo "Nº Guia no Prestador".
+
+    Primeiro a faixa de cabeçalho configurada; se não achar, localiza a
+    âncora numa cópia reduzida e relê só um recorte em volta dela.
+    """
+    largura, altura = imagem.size
+    altura_cabecalho = float(obter_config("ocr", "roi_altura_cabecalho", 0.25))
+    resultado = _ocr_texto(imagem.crop((0, 0, largura, int(altura * altura_cabecalho))), "cabecalho", parar)
+    if resultado[0] or (parar is not None and parar.is_set()):
+        return resultado
+
+    ancora = _localizar_ancora(imagem, float(obter_config("ocr", "roi_escala_ancora", 0.5)))
+    if ancora is None:
+        return None, None, None
+    left, top, right, bottom = ancora
+    # O número fica à direita do rótulo ou logo abaixo dele
+    margem = (bottom - top) * 2
+    recorte = (
+        max(0, left - margem * 4), max(0, top - margem),
+        largura, min(altura, bottom + margem * 2),
+    )
+    return _ocr_texto(imagem.crop(recorte), "ancora", parar)
+
+
+def _obter_pool():
+    """Pool limitado de threads para o modo corrida, recriado após um fork"""
+    with _pool_lock:
+        if _pool_corrida['pid'] != os.getpid():
+            threads = int(obter_config("ocr", "corrida_threads", 4))
+            _pool_corrida['pool'] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="ocr-corrida")
+            _pool_corrida['pid'] = os.getpid()
+        return _pool_corrida['pool']
+
+
+def _correr_tentativas(rotacionadas, tentativas):
+    """Dispara todas as tentativas da página no pool e fica com o primeiro acerto.
+
+    As tentativas são enviadas na ordem de prioridade; ao primeiro número
+    encontrado as que ainda não começaram são canceladas e as em andamento
+    param na próxima variante.
+    """
+    parar = threading.Event()
+    pool = _obter_pool()
+    futuros = {
+        pool.submit(leitor, rotacionadas[angulo], parar=parar): angulo
+        for angulo, leitor in tentativas
+    }
+    try:
+        for futuro in as_completed(futuros):
+            numero, variante, regiao = futuro.result()
+            if numero:
+                return numero, {'angulo': futuros[futuro], 'variante': variante, 'regiao': regiao}
+    finally:
+        parar.set()
+        for futuro in futuros:
+            futuro.cancel()
+    return None, None
+
+
+def buscar_numero_na_pagina(imagem, orientacao=None, confianca_minima=None, roi=None, corrida=None, forca_bruta=True):
+    """Procura o número da guia em uma página renderizada.
+
+    No modo "osd" a orientação é detectada antes e, com confiança
+    suficiente, só esse ângulo é lido; a força bruta sobre os ângulos fica
+    como fallback apenas quando a confiança é baixa.
+    Com `roi` ativo, o ângulo detectado (ou o primeiro da ordem) é lido
+    primeiro só na região do campo; a força bruta nos demais ângulos vai
+    direto para a página inteira. Com `corrida` ativo, todas as
+    tentativas rodam em paralelo e vence a primeira que encontrar o número.
+    Sem `forca_bruta` só as tentativas baratas são feitas: o ângulo
+    detectado pelo OSD ou, sem orientação confiável, o primeiro ângulo da
+    ordem apenas com o primeiro leitor (a região do campo, se `roi`).
+
+    Retorna (numero, detalhes) com o ângulo, a variante e a região que
+    encontraram o número, ou (None, None).
+    """
+    if orientacao is None:
+        orientacao = obter_config("ocr", "orientacao", "osd")
+    if confianca_minima is None:
+        confianca_minima = float(obter_config("ocr", "confianca_minima_osd", 3.0))
+    if roi is None:
+        roi = bool(obter_config("ocr", "roi", True))
+    if corrida is None:
+        corrida = bool(obter_config("ocr", "corrida", False))
+
+    # Tons de cinza uma única vez: rotações, recortes e variantes partem daqui
+    imagem = para_cinza(imagem)
+    leitores = [_ocr_roi, _ocr_texto] if roi else [_ocr_texto]
+    angulos = [a % 360 for a in obter_config("ocr", "ordem_angulos", ANGULOS)]
+    tentativas = []
+    if orientacao == "osd":
+        angulo, confianca = detectar_orientacao(imagem)
+        if confianca >= confianca_minima:
+            tentativas = [(angulo, leitor) for leitor in leitores]
+    # Com orientação confiável os outros ângulos não são testados
+    if not tentativas and forca_bruta:
+        tentativas = [(angulos[0], leitor) for leitor in leitores] + [(angulo, _ocr_texto) for angulo in angulos[1:]]
+    elif not tentativas and angulos:
+        tentativas = [(angulos[0], leitores[0])]
+
+    rotacionadas = {}
+    if corrida:
+        for angulo, _ in tentativas:
+            if angulo not in rotacionadas:
+                rotacionadas[angulo] = rotacionar(imagem, angulo)
+        return _correr_tentativas(rotacionadas, tentativas)
+
+    for angulo, leitor in tentativas:
+        if angulo not in rotacionadas:
+            rotacionadas[angulo] = rotacionar(imagem, angulo)
+        numero, variante, regiao = leitor(rotacionadas[angulo])
+        if numero:
+            return numero, {'angulo': angulo, 'variante': variante, 'regiao': regiao}
+    return None, None
+
+
+def _buscar_com_escada(paginas, page_index, escada):
+    """Lê a página na menor resolução da escada e só re-renderiza em DPI
+    maior quando não encontra. Retorna (numero, detalhes, dpi).
+
+    Os degraus intermediários fazem só as tentativas baratas (ângulo do OSD
+    e região do campo); a força bruta sobre todos os ângulos e variantes
+    roda uma única vez, no último degrau.
+    """
+    for posicao, dpi in enumerate(escada):
+        ultimo = posicao == len(escada) - 1
+        numero, detalhes = buscar_numero_na_pagina(paginas.pagina(page_index, dpi), forca_bruta=ultimo)
+        if numero:
+            return numero, detalhes, dpi
+    return None, None, None
+
+
+# NOVA LÓGICA: OCR antes da compressão com otimizações
+def encontrar_numero_guia(pdf_bytes, avisos=None, max_paginas=2, sha256=None):
+    """Procura o número da guia nas primeiras páginas do PDF.
+
+    Primeiro tenta a camada de texto embutida (PDFs nativos ou já com OCR);
+    só rasteriza e roda o Tesseract nas páginas só-imagem ou quando o texto
+    não contém o número.
+
+    Retorna (numero_guia, total_paginas, info), onde `info` traz o caminho
+    usado ("texto", "ocr" ou None), a página, o degrau de DPI, o ângulo e a
+    variante que encontraram o número e o tipo de cada página lida. Como
+    pode rodar fora da thread do Streamlit, erros não interrompem a busca:
+    viram mensagens em `avisos`.
+    """
+    if avisos is None:
+        avisos = []
+    info = {'metodo': None, 'pagina': None, 'dpi': None, 'angulo': None, 'variante': None, 'tipos_pagina': []}
+
+    # Páginas são renderizadas sob demanda; o total vem dos metadados do PDF
+    escada = [int(dpi) for dpi in obter_config("ocr", "escada_dpi", [150, 200])]
+    paginas = FontePaginas(pdf_bytes, dpi=escada[0], sha256=sha256)
+    total_paginas = 0
+
+    # Caminho rápido: camada de texto via PyMuPDF (milissegundos por página)
+    if obter_config("ocr", "camada_texto", True):
+        try:
+            min_caracteres = int(obter_config("ocr", "min_caracteres_texto", 20))
+            total_paginas, camada = ler_camada_texto(pdf_bytes, max_paginas, min_caracteres)
+            info['tipos_pagina'] = [tipo for _, tipo in camada]
+            for page_index, (texto, tipo) in enumerate(camada):
+                numero = extract_card_number(texto) if tipo == "texto" else None
+                if numero:
+                    info.update(metodo="texto", pagina=page_index + 1)
+                    return numero, total_paginas, info
+        except Exception as e:
+            avisos.append(f"⚠️ Erro ao ler a camada de texto: {str(e)}. Usando OCR...")
+
+    try:
+        total_paginas = total_paginas or paginas.total_paginas
+
+        # Limitar a busca apenas na primeira página para velocidade
+        for page_index in range(min(1, total_paginas)):  # Só primeira página
+            numero, detalhes, dpi = _buscar_com_escada(paginas, page_index, escada)
+            if numero:
+                info.update(metodo="ocr", pagina=page_index + 1, dpi=dpi,
+                            angulo=detalhes['angulo'], variante=detalhes['variante'])
+                return numero, total_paginas, info
+
+        # Se não encontrou na primeira página, tenta segunda (sem timeout para evitar erro de signal)
+        if total_paginas > 1 and max_paginas > 1:
+            try:
+                numero, detalhes, dpi = _buscar_com_escada(paginas, 1, escada)
+                if numero:
+                    info.update(metodo="ocr", pagina=2, dpi=dpi,
+                                angulo=detalhes['angulo'], variante=detalhes['variante'])
+                    return numero, total_paginas, info
+            except Exception as e:
+                avisos.append(f"⚠️ Erro no OCR da segunda página: {str(e)}. Continuando...")
+
+    except Exception as e:
+        avisos.append(f"❌ Erro no OCR: {str(e)}")
+
+    return None, total_paginas, info
@@ -0,0 +1,125 @@
+import os
+import threading
+import pytesseract
+from .config import obter_config
+
+# O OpenMP da libtesseract lê o limite quando a biblioteca é carregada, então
+# ele precisa estar no ambiente antes do import do tesserocr (e antes de o
+# processo principal criar o pool, cujos workers herdam o ambiente). O
+# paralelismo vem dos workers e das threads do modo corrida.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+try:
+    import tesserocr  # API C do Tesseract, mantém o modelo carregado em memória
+except ImportError:
+    tesserocr = None
+
+OCR_LANG = "por+eng"
+
+# Modos de segmentação usados pela busca da guia
+PSM_BLOCO = 6     # Bloco único de texto
+PSM_ESPARSO = 11  # Texto esparso (localização de palavras)
+
+
+class BackendPytesseract:
+    """Backend de compatibilidade: um processo `tesseract` por chamada"""
+
+    nome = "pytesseract"
+
+    def texto(self, imagem, psm=PSM_BLOCO):
+        return pytesseract.image_to_string(imagem, lang=OCR_LANG, config=f"--oem 1 --psm {psm}")
+
+    def palavras(self, imagem):
+        """Lista de (palavra, (left, top, right, bottom))"""
+        dados = pytesseract.image_to_data(
+            imagem, lang=OCR_LANG, config=f"--oem 1 --psm {PSM_ESPARSO}",
+            output_type=pytesseract.Output.DICT
+        )
+        return [
+            (palavra, (dados["left"][i], dados["top"][i],
+                       dados["left"][i] + dados["width"][i], dados["top"][i] + dados["height"][i]))
+            for i, palavra in enumerate(dados["text"]) if palavra.strip()
+        ]
+
+    def orientacao(self, imagem):
+        """(angulo anti-horário que endireita a página, confiança); (0, 0.0) em caso de falha"""
+        try:
+            osd = pytesseract.image_to_osd(imagem, config="--psm 0", output_type=pytesseract.Output.DICT)
+        except pytesseract.TesseractError:
+            return 0, 0.0
+        # O OSD informa a rotação no sentido horário necessária para corrigir a página
+        return (-int(osd.get("rotate", 0))) % 360, float(osd.get("orientation_conf", 0.0))
+
+
+class BackendTesserocr:
+    """Backend persistente: um handle da API C por thread, reaproveitado entre
+    páginas e documentos. As imagens PIL são entregues direto da memória,
+    sem arquivo temporário e sem recarregar o traineddata a cada chamada.
+    """
+
+    nome = "tesserocr"
+
+    def __init__(self):
+        self._api = tesserocr.PyTessBaseAPI(lang=OCR_LANG, oem=tesserocr.OEM.LSTM_ONLY)
+        self._api_osd = None
+
+    def texto(self, imagem, psm=PSM_BLOCO):
+        self._api.SetPageSegMode(psm)
+        self._api.SetImage(imagem)
+        return self._api.GetUTF8Text()
+
+    def palavras(self, imagem):
+        self._api.SetPageSegMode(PSM_ESPARSO)
+        self._api.SetImage(imagem)
+        self._api.Recognize()
+        nivel = tesserocr.RIL.WORD
+        resultado = []
+        for item in tesserocr.iterate_level(self._api.GetIterator(), nivel):
+            palavra = item.GetUTF8Text(nivel)
+            caixa = item.BoundingBox(nivel)
+            if palavra and palavra.strip() and caixa:
+                resultado.append((palavra, caixa))
+        return resultado
+
+    def orientacao(self, imagem):
+        """(angulo anti-horário que endireita a página, confiança); (0, 0.0) em caso de falha"""
+        if self._api_osd is None:
+            try:
+                self._api_osd = tesserocr.PyTessBaseAPI(lang="osd", psm=tesserocr.PSM.OSD_ONLY)
+            except RuntimeError:
+                # Sem osd.traineddata: não tenta de novo a cada página
+                self._api_osd = False
+        if not self._api_osd:
+            return 0, 0.0
+        self._api_osd.SetImage(imagem)
+        osd = self._api_osd.DetectOrientationScript()
+        if not osd:
+            return 0, 0.0
+        # orient_deg já é a rotação anti-horária que endireita a página
+        return int(osd["orient_deg"]) % 360, float(osd["orient_conf"])
+
+
+_locais = threading.local()
+
+
+def obter_backend():
+    """Backend de OCR da thread atual, criado uma única vez por thread/processo.
+
+    `ocr.backend` no config.yml: "auto" (tesserocr se instalado), "tesserocr"
+    ou "pytesseract". Se o tesserocr falhar ao iniciar, cai no pytesseract.
+    """
+    # Após um fork o worker não deve reaproveitar o handle herdado do processo pai
+    if getattr(_locais, "pid", None) != os.getpid():
+        _locais.pid = os.getpid()
+        _locais.backend = None
+
+    if _locais.backend is None:
+        escolha = obter_config("ocr", "backend", "auto")
+        backend = None
+        if escolha in ("auto", "tesserocr") and tesserocr is not None:
+            try:
+                backend = BackendTesserocr()
+            except RuntimeError as e:
+                print(f"⚠️ tesserocr indisponível ({e}), usando pytesseract")
+        _locais.backend = backend or BackendPytesseract()
+    return _locais.backend
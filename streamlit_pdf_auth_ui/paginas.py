@@ -0,0 +1,131 @@
+import hashlib
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+from .cache_renderizacao import obter_cache
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    from pymupdf import fitz  # PyMuPDF
+
+
+def contar_paginas(pdf_bytes):
+    """Retorna o número de páginas a partir dos metadados do PDF, sem renderizar nada"""
+    try:
+        return int(pdfinfo_from_bytes(pdf_bytes)["Pages"])
+    except Exception:
+        # Fallback: PyMuPDF lê a árvore de páginas diretamente
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return doc.page_count
+
+
+def ler_camada_texto(pdf_bytes, max_paginas, min_caracteres=20):
+    """Lê a camada de texto embutida das primeiras páginas com PyMuPDF.
+
+    Retorna (total_paginas, paginas), onde cada item de `paginas` é
+    (texto, tipo) e `tipo` é "texto" quando a página tem camada de texto
+    utilizável ou "imagem" quando só há conteúdo rasterizado.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        paginas = []
+        for page_num in range(min(max_paginas, doc.page_count)):
+            texto = doc.load_page(page_num).get_text()
+            tipo = "texto" if len(texto.strip()) >= min_caracteres else "imagem"
+            paginas.append((texto, tipo))
+        return doc.page_count, paginas
+
+
+def hash_documento(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def renderizar_pagina(pdf_bytes, indice, dpi, sha256=None):
+    """Renderiza uma página (base 0) passando pelo cache de renderização.
+
+    Se a página já foi renderizada em DPI igual ou maior (pelo OCR ou pela
+    divisão), é reaproveitada/reduzida em vez de chamar o poppler de novo.
+    """
+    sha256 = sha256 or hash_documento(pdf_bytes)
+    cache = obter_cache()
+    imagem = cache.obter(sha256, indice, dpi)
+    if imagem is None:
+        # pdf2image usa numeração base 1 para first_page/last_page
+        imagem = convert_from_bytes(pdf_bytes, dpi=dpi, first_page=indice + 1, last_page=indice + 1)[0]
+        cache.guardar(sha256, indice, dpi, imagem)
+    return imagem
+
+
+def renderizar_em_blocos(pdf_bytes, dpi, paginas_por_bloco=8, sha256=None):
+    """Gera as páginas renderizadas uma a uma, com memória limitada.
+
+    O poppler é chamado por blocos de páginas (first_page/last_page) e cada
+    imagem é entregue e descartada antes da próxima, então o pico de
+    memória é de um bloco, qualquer que seja o tamanho do documento.
+    Páginas já presentes no cache de renderização não são renderizadas de
+    novo; as demais não entram no cache para não despejar as úteis.
+    """
+    sha256 = sha256 or hash_documento(pdf_bytes)
+    cache = obter_cache()
+    total_paginas = contar_paginas(pdf_bytes)
+    indice = 0
+    while indice < total_paginas:
+        imagem = cache.obter(sha256, indice, dpi)
+        if imagem is not None:
+            yield imagem
+            indice += 1
+            continue
+
+        # Bloco contíguo de páginas fora do cache
+        ultima = min(indice + paginas_por_bloco, total_paginas)
+        for fim in range(indice + 1, ultima):
+            if cache.obter(sha256, fim, dpi) is not None:
+                ultima = fim
+                break
+        bloco = convert_from_bytes(pdf_bytes, dpi=dpi, first_page=indice + 1, last_page=ultima)
+        bloco.reverse()
+        while bloco:
+            # pop() solta a referência do bloco assim que a página é consumida
+            yield bloco.pop()
+        indice = ultima
+
+
+class FontePaginas:
+    """Fonte preguiçosa de páginas de um PDF.
+
+    O total de páginas vem dos metadados e cada página só é rasterizada
+    quando solicitada, uma de cada vez. `dpi` é o padrão; cada chamada a
+    `pagina` pode pedir outra resolução. As renderizações passam pelo cache
+    de renderização compartilhado com a etapa de divisão, que mantém as
+    páginas em memória e em disco até o documento ser descartado.
+    """
+
+    def __init__(self, pdf_bytes, dpi=200, sha256=None):
+        self.pdf_bytes = pdf_bytes
+        self.dpi = dpi
+        self.sha256 = sha256 or hash_documento(pdf_bytes)
+        self._total_paginas = None
+        self._ultima = (None, None)  # ((indice, dpi), imagem)
+
+    @property
+    def total_paginas(self):
+        if self._total_paginas is None:
+            self._total_paginas = contar_paginas(self.pdf_bytes)
+        return self._total_paginas
+
+    def __len__(self):
+        return self.total_paginas
+
+    def pagina(self, indice, dpi=None):
+        """Renderiza a página `indice` (base 0) sob demanda"""
+        dpi = dpi or self.dpi
+        if not 0 <= indice < self.total_paginas:
+            raise IndexError(f"Página {indice + 1} fora do intervalo (total: {self.total_paginas})")
+
+        if self._ultima[0] == (indice, dpi):
+            return self._ultima[1]
+
+        imagem = renderizar_pagina(self.pdf_bytes, indice, dpi, self.sha256)
+        self._ultima = ((indice, dpi), imagem)
+        return imagem
+
+    def __iter__(self):
+        for indice in range(self.total_paginas):
+            yield self.pagina(indice)
@@ -0,0 +1,59 @@
+# Pré-processamento das páginas para OCR: a conversão para tons de cinza é
+# feita uma única vez e cada binarização é uma tabela (LUT) aplicada em C
+# pelo Pillow, sem lambda por pixel.
+
+
+def _lut_limiar(limiar):
+    """Tabela de 256 posições: abaixo de `limiar` vira preto, o resto branco"""
+    return [0] * limiar + [255] * (256 - limiar)
+
+
+# Limiares fixos históricos (pré-computados uma vez por processo)
+LIMIARES_FIXOS = [("clara", 180), ("escura", 160)]
+_LUTS_FIXAS = {nome: _lut_limiar(limiar) for nome, limiar in LIMIARES_FIXOS}
+
+# Um limiar fixo é pulado quando fica a menos disto do limiar de Otsu
+_DISTANCIA_MINIMA = 10
+
+
+def para_cinza(image):
+    """Converte para tons de cinza apenas se ainda não estiver em "L" """
+    return image if image.mode == "L" else image.convert("L")
+
+
+def limiar_otsu(histograma):
+    """Limiar de Otsu a partir do histograma de 256 níveis da imagem"""
+    total = sum(histograma)
+    soma_total = sum(nivel * qtd for nivel, qtd in enumerate(histograma))
+    soma_fundo = peso_fundo = 0
+    melhor_variancia, limiar = 0.0, 128
+    for nivel, qtd in enumerate(histograma):
+        peso_fundo += qtd
+        if peso_fundo == 0:
+            continue
+        peso_frente = total - peso_fundo
+        if peso_frente == 0:
+            break
+        soma_fundo += nivel * qtd
+        media_fundo = soma_fundo / peso_fundo
+        media_frente = (soma_total - soma_fundo) / peso_frente
+        variancia = peso_fundo * peso_frente * (media_fundo - media_frente) ** 2
+        if variancia > melhor_variancia:
+            melhor_variancia, limiar = variancia, nivel + 1
+    return limiar
+
+
+def preprocess_variants(image):
+    """Gera (nome, imagem binarizada) para OCR, da mais para a menos provável.
+
+    A primeira variante usa o limiar de Otsu da própria página; os limiares
+    fixos só entram se forem diferentes o bastante do de Otsu. É um gerador:
+    variantes seguintes só são calculadas se a anterior não resolveu.
+    """
+    gray = para_cinza(image)
+    otsu = limiar_otsu(gray.histogram())
+    yield "otsu", gray.point(_lut_limiar(otsu))
+
+    for nome, limiar in LIMIARES_FIXOS:
+        if abs(limiar - otsu) > _DISTANCIA_MINIMA:
+            yield nome, gray.point(_LUTS_FIXAS[nome])
@@ -0,0 +1,257 @@
+import os
+import time
+import hashlib
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from .config import obter_config
+from .cache_renderizacao import obter_cache, dividir_orcamento_cache
+from .divisor import reduzir_ou_dividir_pdf
+from .armazenamento import salvar_parte_provisoria, descartar_partes
+from .ocr import encontrar_numero_guia
+from .utils import get_cached_ocr_results, save_ocr_result, evict_ocr_cache
+
+# Acima deste tamanho o PDF é dividido/reduzido
+LIMITE_MB = 200
+MAX_PARTES = 10
+
+# Pool de processos reaproveitado entre lotes e sessões (ver _obter_executor)
+_executor = {'pool': None, 'workers': None}
+_executor_lock = threading.Lock()
+
+
+def obter_num_workers():
+    """Número de processos do pool (config `processamento.workers`, padrão: CPUs)"""
+    workers = obter_config("processamento", "workers")
+    return max(1, int(workers)) if workers else (os.cpu_count() or 1)
+
+
+def _inicializar_worker(workers):
+    # O orçamento do cache de renderização é do pool todo, não de cada worker
+    dividir_orcamento_cache(workers)
+
+
+def _contexto_pool():
+    # Sem fork: o processo do Streamlit tem threads (servidor, scheduler de
+    # limpeza) e bibliotecas nativas carregadas que não sobrevivem a um fork
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    contexto = multiprocessing.get_context("forkserver")
+    # O forkserver importa o pipeline uma vez; os workers nascem com ele carregado
+    contexto.set_forkserver_preload([__name__])
+    return contexto
+
+
+def _obter_executor(workers):
+    """Pool de `workers` processos, criado uma vez e reaproveitado pelos lotes seguintes"""
+    with _executor_lock:
+        if _executor['pool'] is None or _executor['workers'] != workers:
+            if _executor['pool'] is not None:
+                _executor['pool'].shutdown(wait=False, cancel_futures=True)
+            _executor['pool'] = ProcessPoolExecutor(max_workers=workers, mp_context=_contexto_pool(),
+                                                    initializer=_inicializar_worker, initargs=(workers,))
+            _executor['workers'] = workers
+        return _executor['pool']
+
+
+def _descartar_executor(pool):
+    """Tira de uso um pool quebrado (worker morto); o próximo lote cria outro"""
+    with _executor_lock:
+        if _executor['pool'] is pool:
+            _executor['pool'] = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _hash_arquivo(arquivo):
+    """SHA-256 e tamanho de um arquivo enviado, lido em blocos"""
+    arquivo.seek(0)
+    sha256 = hashlib.sha256()
+    tamanho = 0
+    for bloco in iter(lambda: arquivo.read(1024 * 1024), b""):
+        sha256.update(bloco)
+        tamanho += len(bloco)
+    return sha256.hexdigest(), tamanho
+
+
+def _ler_arquivo(arquivo):
+    arquivo.seek(0)
+    return arquivo.read()
+
+
+def _resultado_com_erro(indice, nome, tamanho, erro):
+    """Resultado de um arquivo cujo processamento levantou exceção (no worker ou no pool)"""
+    return {
+        'indice': indice,
+        'nome': nome,
+        'numero_guia': None,
+        'total_paginas': 0,
+        'metodo': None,
+        'tipos_pagina': [],
+        'resultado_ocr': {},
+        'cache_hit': False,
+        'tamanho_mb': tamanho / (1024 * 1024),
+        'compactado': False,
+        'partes': [],
+        'avisos': [],
+        'erro': f"{type(erro).__name__}: {erro}",
+    }
+
+
+def processar_arquivo(indice, nome, pdf_bytes, sha256, diretorio_lote, resultado_ocr=None):
+    """Pipeline de um arquivo: OCR do número da guia + divisão se necessário.
+
+    Roda dentro de um worker do pool, por isso não chama o Streamlit: tudo
+    que deve aparecer na tela volta no dicionário de resultado. Se
+    `resultado_ocr` vier do cache, a busca pelo número é pulada. As páginas
+    renderizadas pelo OCR ficam no cache de renderização e são reaproveitadas
+    pela divisão. As partes são gravadas aqui mesmo em `diretorio_lote`, com
+    nome provisório; `partes` traz só os descritores delas.
+    """
+    try:
+        avisos = []
+        cache_hit = resultado_ocr is not None
+        if not cache_hit:
+            inicio = time.time()
+            numero_guia, total_paginas, info_busca = encontrar_numero_guia(pdf_bytes, avisos, sha256=sha256)
+            resultado_ocr = {
+                'numero_guia': numero_guia,
+                'total_paginas': total_paginas,
+                'metodo': info_busca['metodo'],
+                'pagina': info_busca['pagina'],
+                'dpi': info_busca['dpi'],
+                'angulo': info_busca['angulo'],
+                'variante': info_busca['variante'],
+                'duracao_ms': int((time.time() - inicio) * 1000),
+            }
+            tipos_pagina = info_busca['tipos_pagina']
+        else:
+            tipos_pagina = []
+
+        tamanho_mb = len(pdf_bytes) / (1024 * 1024)
+        resultado = {
+            'indice': indice,
+            'nome': nome,
+            'numero_guia': resultado_ocr['numero_guia'],
+            'total_paginas': resultado_ocr['total_paginas'],
+            'metodo': resultado_ocr['metodo'],
+            'tipos_pagina': tipos_pagina,
+            'resultado_ocr': resultado_ocr,
+            'cache_hit': cache_hit,
+            'tamanho_mb': tamanho_mb,
+            'compactado': False,
+            'partes': [],
+            'avisos': avisos,
+            'erro': None,
+        }
+
+        def gravar(idx, dados):
+            return salvar_parte_provisoria(diretorio_lote, indice, idx, dados)
+
+        # REDUZIR SE NECESSÁRIO (cada parte vai para o disco assim que é produzida)
+        try:
+            if tamanho_mb > LIMITE_MB:
+                resultado['partes'] = reduzir_ou_dividir_pdf(pdf_bytes, max_mb=LIMITE_MB, max_partes=MAX_PARTES, sha256=sha256,
+                                                             gravar=gravar, descartar=descartar_partes)
+                resultado['compactado'] = True
+            else:
+                resultado['partes'] = [gravar(0, pdf_bytes)]
+        except ValueError as e:
+            resultado['erro'] = str(e)
+        except OSError as e:
+            resultado['erro'] = f"Falha ao gravar {nome} no disco: {str(e)}"
+        return resultado
+    finally:
+        # O documento terminou (com ou sem erro): libera as páginas dele do cache de renderização
+        obter_cache().descartar(sha256)
+
+
+def _consultar_cache(hashes):
+    """Busca no cache de OCR os resultados já conhecidos, por índice do arquivo"""
+    if not obter_config("cache_ocr", "ativo", True):
+        return {}
+    ttl_horas = int(obter_config("cache_ocr", "ttl_horas", 720))
+    # Uma consulta para o lote todo; arquivos repetidos no lote compartilham o resultado
+    por_hash = get_cached_ocr_results(hashes, ttl_horas)
+    return {indice: por_hash[sha256] for indice, sha256 in enumerate(hashes) if sha256 in por_hash}
+
+
+def _salvar_no_cache(sha256, resultado):
+    # Falhas (avisos de OCR ou erro no processamento) não são cacheadas para que
+    # um novo envio tente de novo. "Guia não encontrada" numa leitura sem falhas
+    # é cacheada: é o resultado mais caro de repetir
+    if (resultado['cache_hit'] or resultado['avisos'] or resultado['erro']
+            or not obter_config("cache_ocr", "ativo", True)):
+        return
+    save_ocr_result(sha256, resultado['resultado_ocr'])
+
+
+def processar_em_paralelo(arquivos, diretorio_lote, workers=None):
+    """Processa `arquivos` [(nome, arquivo), ...] em um ProcessPoolExecutor.
+
+    `arquivo` é um objeto de arquivo (ex.: o UploadedFile do Streamlit); o
+    conteúdo só é lido quando o arquivo é enviado ao pool, e no máximo
+    2x workers arquivos ficam em trânsito ao mesmo tempo. Gera os resultados
+    conforme terminam (ordem arbitrária); use o campo `indice` para
+    reordenar. Com um único worker roda no próprio processo.
+    As partes ficam em `diretorio_lote` com nome provisório (ver
+    `armazenamento.publicar_parte`).
+    Exceções de um arquivo não interrompem o lote: voltam no campo `erro`.
+    Se o gerador for fechado (rerun do Streamlit no meio do lote), os
+    arquivos que ainda não começaram são cancelados.
+    Arquivos já vistos (mesmo SHA-256) reaproveitam o OCR do cache.
+    """
+    if workers is None:
+        workers = obter_num_workers()
+
+    hashes, tamanhos = zip(*(_hash_arquivo(arquivo) for _, arquivo in arquivos)) if arquivos else ((), ())
+    cache = _consultar_cache(hashes)
+
+    if min(workers, len(arquivos)) <= 1:
+        for indice, (nome, arquivo) in enumerate(arquivos):
+            try:
+                resultado = processar_arquivo(indice, nome, _ler_arquivo(arquivo), hashes[indice], diretorio_lote, cache.get(indice))
+            except Exception as e:
+                resultado = _resultado_com_erro(indice, nome, tamanhos[indice], e)
+            else:
+                _salvar_no_cache(hashes[indice], resultado)
+            yield resultado
+    else:
+        pool = _obter_executor(workers)
+        proximos = iter(enumerate(arquivos))
+        pendentes = {}
+        try:
+            while True:
+                for indice, (nome, arquivo) in itertools.islice(proximos, workers * 2 - len(pendentes)):
+                    try:
+                        futuro = pool.submit(processar_arquivo, indice, nome, _ler_arquivo(arquivo),
+                                             hashes[indice], diretorio_lote, cache.get(indice))
+                    except BrokenProcessPool as e:
+                        yield _resultado_com_erro(indice, nome, tamanhos[indice], e)
+                    else:
+                        pendentes[futuro] = indice
+                if not pendentes:
+                    break
+                concluidos, _ = wait(pendentes, return_when=FIRST_COMPLETED)
+                for futuro in concluidos:
+                    # Uma falha (poppler, worker morto/BrokenProcessPool) vira o erro
+                    # daquele arquivo; os demais resultados seguem normalmente
+                    indice = pendentes.pop(futuro)
+                    try:
+                        resultado = futuro.result()
+                    except Exception as e:
+                        if isinstance(e, BrokenProcessPool):
+                            _descartar_executor(pool)
+                        resultado = _resultado_com_erro(indice, arquivos[indice][0], tamanhos[indice], e)
+                    else:
+                        _salvar_no_cache(hashes[indice], resultado)
+                    yield resultado
+        finally:
+            # Interrompido (GeneratorExit) ou terminado: nada fica na fila do pool compartilhado
+            for futuro in pendentes:
+                futuro.cancel()
+
+    if obter_config("cache_ocr", "ativo", True) and len(cache) < len(arquivos):
+        evict_ocr_cache(int(obter_config("cache_ocr", "ttl_horas", 720)),
+                        int(obter_config("cache_ocr", "max_entradas", 100000)))
@@ -0,0 +1,190 @@
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+import psycopg2
+from .config import obter_config
+from .conexoes import conexao
+
+
+def _b64(dados: bytes) -> str:
+    return base64.urlsafe_b64encode(dados).rstrip(b"=").decode()
+
+
+def _de_b64(texto: str) -> bytes:
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+
+def _chave():
+    """(versão, chave) de assinatura, de `cookie.key` / `cookie.versao_chave` no config.yml"""
+    return int(obter_config("cookie", "versao_chave", 1)), obter_config("cookie", "key").encode()
+
+
+def _assinar(corpo: str, chave: bytes) -> str:
+    return _b64(hmac.new(chave, corpo.encode(), hashlib.sha256).digest())
+
+
+def emitir_token(username: str, user_type: str, dias=None) -> str:
+    """Token de sessão assinado (HMAC-SHA256): `<payload>.<assinatura>`.
+
+    O payload leva usuário, tipo, emissão, expiração, versão da chave e um
+    id único (para revogação individual no logout).
+    """
+    versao, chave = _chave()
+    dias = dias if dias is not None else int(obter_config("cookie", "expiry_days", 30))
+    agora = time.time()
+    payload = {
+        'u': username,
+        't': user_type,
+        'iat': int(agora * 1000),  # ms, para comparar com revogações no mesmo segundo
+        'exp': int(agora) + dias * 86400,
+        'kv': versao,
+        'jti': secrets.token_hex(16),
+    }
+    corpo = _b64(json.dumps(payload, separators=(",", ":")).encode())
+    return f"{corpo}.{_assinar(corpo, chave)}"
+
+
+def validar_token(token):
+    """Payload do token se a assinatura, a versão da chave, a validade e a
+    lista de revogação permitirem; senão None. Cookies adulterados ou
+    malformados também dão None, nunca exceção. O banco só é lido na
+    releitura periódica da lista de revogação."""
+    if not isinstance(token, str) or token.count(".") != 1:
+        return None
+    corpo, assinatura = token.split(".")
+    versao, chave = _chave()
+    try:
+        # Em bytes: compare_digest levanta TypeError para str com não-ASCII
+        if not hmac.compare_digest(assinatura.encode("ascii"), _assinar(corpo, chave).encode("ascii")):
+            return None
+    except UnicodeEncodeError:
+        return None
+    try:
+        payload = json.loads(_de_b64(corpo))
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    if payload.get('kv') != versao or payload.get('exp', 0) <= time.time():
+        return None
+    if revogacoes.revogado(payload):
+        return None
+    return payload
+
+
+class ListaRevogacao:
+    """Tokens revogados antes de expirar, consultados em memória.
+
+    Dois tipos de entrada: um token específico (`jti`, no logout) e todos os
+    tokens de um usuário emitidos até um instante (troca de senha, alteração
+    ou exclusão do usuário). O usuário "*" vale para todos. As entradas são
+    gravadas no Postgres; a cópia em memória é relida a cada
+    `cookie.revogacao_ttl_segundos`, só com o que foi revogado depois da
+    última leitura, para enxergar revogações de outros processos/réplicas.
+
+    Falha fechada: enquanto a lista nunca foi carregada (banco fora do ar),
+    todo token é recusado. Se uma releitura falhar, fica a última cópia e a
+    próxima tentativa espera o intervalo, sem ir ao banco a cada validação.
+    """
+
+    # Revogações gravadas pouco antes da marca podem ter sido confirmadas
+    # depois da última leitura (ou vir de um relógio um pouco atrasado)
+    _MARGEM_MS = 60_000
+
+    def __init__(self):
+        self._tokens = {}    # jti -> expira_em
+        self._usuarios = {}  # username -> revogado_em em ms (tokens com iat <= isso são inválidos)
+        self._marca = None   # maior revogado_em lido do banco; None enquanto nunca carregou
+        self._proxima_leitura = 0.0
+        self._lock = threading.Lock()
+
+    def _atualizar(self):
+        with self._lock:
+            agora = time.monotonic()
+            if agora < self._proxima_leitura:
+                return
+            self._proxima_leitura = agora + float(obter_config("cookie", "revogacao_ttl_segundos", 30))
+            try:
+                with conexao() as conn, conn.cursor() as cursor:
+                    if self._marca is None:
+                        cursor.execute('DELETE FROM sessoes_revogadas WHERE expira_em <= %s', (int(time.time()),))
+                        cursor.execute('SELECT tipo, valor, revogado_em, expira_em FROM sessoes_revogadas')
+                    else:
+                        cursor.execute('''
+                            SELECT tipo, valor, revogado_em, expira_em FROM sessoes_revogadas
+                            WHERE revogado_em > %s
+                        ''', (self._marca - self._MARGEM_MS,))
+                    linhas = cursor.fetchall()
+                    conn.commit()
+            except psycopg2.Error as err:
+                print(f"Error: {err}")
+                return
+
+            marca = self._marca or 0
+            for tipo, valor, revogado_em, expira_em in linhas:
+                if tipo == 'token':
+                    self._tokens[valor] = expira_em
+                else:
+                    self._usuarios[valor] = max(self._usuarios.get(valor, 0), revogado_em)
+                marca = max(marca, revogado_em)
+            agora_s = time.time()
+            self._tokens = {jti: expira_em for jti, expira_em in self._tokens.items() if expira_em > agora_s}
+            self._marca = marca
+
+    def revogado(self, payload):
+        self._atualizar()
+        if self._marca is None:
+            return True
+        if payload.get('jti') in self._tokens:
+            return True
+        limite = max(self._usuarios.get(payload.get('u'), 0), self._usuarios.get('*', 0))
+        return payload.get('iat', 0) <= limite
+
+    def _gravar(self, tipo, valor, revogado_em, expira_em):
+        try:
+            with conexao() as conn, conn.cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO sessoes_revogadas (tipo, valor, revogado_em, expira_em)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (tipo, valor) DO UPDATE SET
+                        revogado_em = EXCLUDED.revogado_em, expira_em = EXCLUDED.expira_em
+                ''', (tipo, valor, revogado_em, expira_em))
+                conn.commit()
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+
+    def revogar_token(self, payload):
+        self._tokens[payload['jti']] = payload['exp']
+        self._gravar('token', payload['jti'], int(time.time() * 1000), payload['exp'])
+
+    def revogar_usuario(self, username):
+        agora = time.time()
+        self._usuarios[username] = int(agora * 1000)
+        # Nenhum token emitido antes de agora passa da validade máxima configurada
+        expira_em = int(agora) + int(obter_config("cookie", "expiry_days", 30)) * 86400
+        self._gravar('usuario', username, int(agora * 1000), expira_em)
+
+
+revogacoes = ListaRevogacao()
+
+
+def revogar_token(token):
+    """Logout: invalida só este token"""
+    payload = validar_token(token)
+    if payload:
+        revogacoes.revogar_token(payload)
+
+
+def revogar_sessoes_usuario(*usernames):
+    """Invalida todos os tokens já emitidos para os usuários (troca de senha, alteração, exclusão)"""
+    for username in usernames:
+        revogacoes.revogar_usuario(username)
+
+
+def revogar_todas_sessoes():
+    """Invalida todos os tokens emitidos até agora (ex.: tipos de usuário alterados)"""
+    revogacoes.revogar_usuario('*')
@@ -4,228 +4,247 @@ import secrets
 import uuid
 from argon2 import PasswordHasher
 import requests
-import yaml
-import os
 import streamlit as st
+from .conexoes import conexao, obter_pool, parametros_conexao
+from .migracoes import migrar_uma_vez
+from .sessao import revogar_sessoes_usuario, revogar_todas_sessoes
 
 def get_db_connection(with_database=True):
-    connection_params = {
-        'host': os.getenv('POSTGRES_HOST', 'postgres'),
-        'user': os.getenv('POSTGRES_USER', 'postgres'),
-        'password': os.getenv('POSTGRES_PASSWORD', 'postgres'),
-        'port': 5432
-    }
-    if with_database:
-        connection_params['database'] = os.getenv('POSTGRES_DB', 'auth_db')
-    return psycopg2.connect(**connection_params)
+    """Conexão avulsa, fora do pool (as funções deste módulo usam `conexao()`)"""
+    return psycopg2.connect(**parametros_conexao(with_database))
+
+def get_db_pool_stats():
+    """Uso do pool de conexões: checkouts, conexões em uso/pico, espera média/máxima, timeouts"""
+    return obter_pool().estatisticas()
 
 def init_db():
-    # Conecta ao banco de dados específico (PostgreSQL cria o banco automaticamente)
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """Cria/atualiza o schema e os usuários iniciais, uma única vez por processo.
 
+    As migrações versionadas ficam em `migracoes.py`; chamadas seguintes
+    no mesmo processo retornam sem tocar no banco.
+    """
     try:
-        # Criação das tabelas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_types (
-                id VARCHAR(36) PRIMARY KEY,
-                type_name VARCHAR(255) UNIQUE NOT NULL
-            );
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id VARCHAR(36) PRIMARY KEY,
-                username VARCHAR(255) UNIQUE NOT NULL,
-                email VARCHAR(255) UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                user_type_id VARCHAR(36),
-                FOREIGN KEY (user_type_id) REFERENCES user_types(id)
-            );
-        ''')
-        conn.commit()
-
-        # Carrega os dados dos usuários do arquivo YAML
-        with open('users_config.yml', 'r') as file:
-            config = yaml.safe_load(file)
-            users = config['users']
-
-        # Insere os tipos de usuário no banco de dados
-        user_types = set(user_info['type'] for user_info in users.values())
-        type_id_map = {}
-        for user_type in user_types:
-            type_id = str(uuid.uuid4())
-            type_id_map[user_type] = type_id
-            try:
-                cursor.execute(
-                    'INSERT INTO user_types (id, type_name) VALUES (%s, %s)',
-                    (type_id, user_type)
-                )
-                conn.commit()
-            except psycopg2.IntegrityError:
-                cursor.execute(
-                    'SELECT id FROM user_types WHERE type_name = %s',
-                    (user_type,)
-                )
-                existing_type = cursor.fetchone()
-                type_id_map[user_type] = existing_type[0]
-                conn.rollback()  # Rola para trás a transação em caso de erro
-
-        # Insere os usuários no banco de dados
-        for user_info in users.values():
-            try:
-                hashed_password = PasswordHasher().hash(user_info['password'])
-                cursor.execute(
-                    'INSERT INTO users (id, username, email, password, user_type_id) VALUES (%s, %s, %s, %s, %s)',
-                    (str(uuid.uuid4()), user_info['username'], user_info['email'], hashed_password, type_id_map[user_info['type']])
-                )
-                conn.commit()
-            except psycopg2.IntegrityError:
-                print(f"Usuário {user_info['username']} já existe.")
-                conn.rollback()  # Rola para trás a transação em caso de erro
-
+        migrar_uma_vez()
     except psycopg2.Error as err:
         print(f"Error: {err}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
 
 # Funções CRUD para user_types
 def create_user_type(type_name: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('INSERT INTO user_types (id, type_name) VALUES (%s, %s)', (str(uuid.uuid4()), type_name))
-        conn.commit()
-    except psycopg2.IntegrityError:
-        print(f"User type {type_name} already exists.")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('INSERT INTO user_types (id, type_name) VALUES (%s, %s)', (str(uuid.uuid4()), type_name))
+            conn.commit()
+        except psycopg2.IntegrityError:
+            print(f"User type {type_name} already exists.")
+            conn.rollback()
 
 def list_user_types():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM user_types')
-    user_types = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT * FROM user_types')
+        user_types = cursor.fetchall()
     # Converter para formato de dicionário
     return [{'id': row[0], 'type_name': row[1]} for row in user_types]
 
+def _ilike_pattern(search: str) -> str:
+    # Escapa os curingas do ILIKE para que a busca seja por substring literal
+    return '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def list_user_types_page(search: str = None, after: str = None, limit: int = 50):
+    """Página de tipos ordenada por type_name (paginação por keyset).
+
+    `after` é o último type_name da página anterior. Retorna (linhas,
+    próximo cursor ou None se for a última página).
+    """
+    conditions, params = [], []
+    if search:
+        conditions.append('type_name ILIKE %s')
+        params.append(_ilike_pattern(search))
+    if after is not None:
+        conditions.append('type_name > %s')
+        params.append(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute(f'SELECT id, type_name FROM user_types {where} ORDER BY type_name LIMIT %s',
+                       (*params, limit + 1))
+        rows = cursor.fetchall()
+    next_cursor = rows[limit - 1][1] if len(rows) > limit else None
+    return [{'id': row[0], 'type_name': row[1]} for row in rows[:limit]], next_cursor
+
 def update_user_type(type_id: str, new_type_name: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('UPDATE user_types SET type_name = %s WHERE id = %s', (new_type_name, type_id))
-        conn.commit()
-    except psycopg2.Error as err:
-        print(f"Error: {err}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('UPDATE user_types SET type_name = %s WHERE id = %s', (new_type_name, type_id))
+            conn.commit()
+            revogar_todas_sessoes()  # Os tokens carregam o nome do tipo
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
 
 def delete_user_type(type_id: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('DELETE FROM user_types WHERE id = %s', (type_id,))
-        conn.commit()
-    except psycopg2.Error as err:
-        print(f"Error: {err}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('DELETE FROM user_types WHERE id = %s', (type_id,))
+            conn.commit()
+            revogar_todas_sessoes()  # Os tokens carregam o nome do tipo
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
 
 def get_user_type_by_id(type_id: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM user_types WHERE id = %s', (type_id,))
-    user_type = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT * FROM user_types WHERE id = %s', (type_id,))
+        user_type = cursor.fetchone()
     if user_type:
         return {'id': user_type[0], 'type_name': user_type[1]}
     return None
 
 # Funções CRUD para usuários
 def register_new_usr(email_sign_up: str, username_sign_up: str, password_sign_up: str, user_type_id: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
     new_user_id = str(uuid.uuid4())
     ph = PasswordHasher()
     hashed_password = ph.hash(password_sign_up)
-    try:
-        cursor.execute('INSERT INTO users (id, username, email, password, user_type_id) VALUES (%s, %s, %s, %s, %s)',
-                       (new_user_id, username_sign_up, email_sign_up, hashed_password, user_type_id))
-        conn.commit()
-    except psycopg2.IntegrityError:
-        print(f"Usuário {username_sign_up} já existe.")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('INSERT INTO users (id, username, email, password, user_type_id) VALUES (%s, %s, %s, %s, %s)',
+                           (new_user_id, username_sign_up, email_sign_up, hashed_password, user_type_id))
+            conn.commit()
+        except psycopg2.IntegrityError:
+            print(f"Usuário {username_sign_up} já existe.")
+            conn.rollback()
 
 def list_users():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users')
-    users = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT * FROM users')
+        users = cursor.fetchall()
     # Converter para formato de dicionário
     return [{'id': row[0], 'username': row[1], 'email': row[2], 'password': row[3], 'user_type_id': row[4]} for row in users]
 
+def list_users_page(search: str = None, after: str = None, limit: int = 50):
+    """Página de usuários ordenada por username (paginação por keyset).
+
+    Traz só id, username, email e o nome do tipo (join no banco, sem o hash
+    da senha). `search` filtra o username por substring (ILIKE, acelerado
+    pelo índice trigram quando o pg_trgm está disponível); `after` é o
+    último username da página anterior. Retorna (linhas, próximo cursor ou
+    None se for a última página).
+    """
+    conditions, params = [], []
+    if search:
+        conditions.append('u.username ILIKE %s')
+        params.append(_ilike_pattern(search))
+    if after is not None:
+        conditions.append('u.username > %s')
+        params.append(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute(f'''
+            SELECT u.id, u.username, u.email, COALESCE(ut.type_name, 'Unknown')
+            FROM users u
+            LEFT JOIN user_types ut ON ut.id = u.user_type_id
+            {where}
+            ORDER BY u.username
+            LIMIT %s
+        ''', (*params, limit + 1))
+        rows = cursor.fetchall()
+    next_cursor = rows[limit - 1][1] if len(rows) > limit else None
+    return [{'id': row[0], 'username': row[1], 'email': row[2], 'type_name': row[3]} for row in rows[:limit]], next_cursor
+
 def update_user(user_id: str, new_username: str, new_email: str, new_user_type: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('UPDATE users SET username = %s, email = %s, user_type_id = %s WHERE id = %s', (new_username, new_email, new_user_type, user_id))
-        conn.commit()
-    except psycopg2.Error as err:
-        print(f"Error: {err}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('''
+                UPDATE users u SET username = %s, email = %s, user_type_id = %s
+                FROM users antigo WHERE antigo.id = u.id AND u.id = %s
+                RETURNING antigo.username
+            ''', (new_username, new_email, new_user_type, user_id))
+            antigos = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            revogar_sessoes_usuario(*antigos)
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
 
 def delete_user(user_id: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute('DELETE FROM users WHERE id = %s', (user_id,))
-        conn.commit()
-    except psycopg2.Error as err:
-        print(f"Error: {err}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('DELETE FROM users WHERE id = %s RETURNING username', (user_id,))
+            removidos = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            revogar_sessoes_usuario(*removidos)
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
+
+# Funções do cache de OCR
+def get_cached_ocr_results(hashes: list, ttl_hours: int):
+    """Retorna {sha256: resultado} dos hashes com OCR salvo ainda dentro do TTL, numa única consulta"""
+    if not hashes:
+        return {}
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('''
+                UPDATE ocr_cache SET ultimo_acesso = NOW()
+                WHERE sha256 = ANY(%s) AND criado_em > NOW() - make_interval(hours => %s)
+                RETURNING sha256, numero_guia, total_paginas, metodo, pagina, dpi, angulo, variante, duracao_ms
+            ''', (list(set(hashes)), ttl_hours))
+            rows = cursor.fetchall()
+            conn.commit()
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
+            rows = []
+    return {row[0]: {'numero_guia': row[1], 'total_paginas': row[2], 'metodo': row[3], 'pagina': row[4],
+                     'dpi': row[5], 'angulo': row[6], 'variante': row[7], 'duracao_ms': row[8]}
+            for row in rows}
+
+def save_ocr_result(sha256: str, result: dict):
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('''
+                INSERT INTO ocr_cache (sha256, numero_guia, total_paginas, metodo, pagina, dpi, angulo, variante, duracao_ms)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (sha256) DO UPDATE SET
+                    numero_guia = EXCLUDED.numero_guia, total_paginas = EXCLUDED.total_paginas,
+                    metodo = EXCLUDED.metodo, pagina = EXCLUDED.pagina, dpi = EXCLUDED.dpi, angulo = EXCLUDED.angulo,
+                    variante = EXCLUDED.variante, duracao_ms = EXCLUDED.duracao_ms,
+                    criado_em = NOW(), ultimo_acesso = NOW()
+            ''', (sha256, result['numero_guia'], result['total_paginas'], result['metodo'], result['pagina'],
+                  result.get('dpi'), result['angulo'], result['variante'], result['duracao_ms']))
+            conn.commit()
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
+
+def evict_ocr_cache(ttl_hours: int, max_entries: int):
+    """Remove entradas expiradas e mantém só as `max_entries` acessadas mais recentemente"""
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('DELETE FROM ocr_cache WHERE criado_em <= NOW() - make_interval(hours => %s)', (ttl_hours,))
+            cursor.execute('''
+                DELETE FROM ocr_cache WHERE sha256 IN (
+                    SELECT sha256 FROM ocr_cache ORDER BY ultimo_acesso DESC OFFSET %s
+                )
+            ''', (max_entries,))
+            conn.commit()
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
 
 # Funções auxiliares
-@st.cache_data(ttl=None, show_spinner=True)
 def check_usr_pass(username: str, password: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT u.password, ut.type_name 
-        FROM users u
-        JOIN user_types ut ON u.user_type_id = ut.id
-        WHERE u.username = %s
-    ''', (username,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    """Retorna (autenticado, type_name) conferindo a senha com o hash Argon2 do banco"""
+    if not password:
+        return False, None
+
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('''
+            SELECT u.password, ut.type_name 
+            FROM users u
+            JOIN user_types ut ON u.user_type_id = ut.id
+            WHERE u.username = %s
+        ''', (username,))
+        user = cursor.fetchone()
     if user:
-        # Se password está vazio, apenas verifica se o usuário existe (para validação de sessão)
-        if not password:
-            return True, user[1]  # user[1] é o type_name
-        
-        # Verifica a senha normalmente
         ph = PasswordHasher()
         try:
             if ph.verify(user[0], password):  # user[0] é o password
@@ -243,12 +262,9 @@ def check_valid_email(email_sign_up: str) -> bool:
 
 @st.cache_data(ttl=None, show_spinner=True)
 def check_unique_email(email_sign_up: str) -> bool:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM users WHERE email = %s', (email_sign_up,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT id FROM users WHERE email = %s', (email_sign_up,))
+        user = cursor.fetchone()
     return user is None
 
 @st.cache_data(ttl=None, show_spinner=True)
@@ -256,34 +272,25 @@ def check_unique_usr(username_sign_up: str) -> bool:
     if not non_empty_str_check(username_sign_up):
         return False
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM users WHERE username = %s', (username_sign_up,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT id FROM users WHERE username = %s', (username_sign_up,))
+        user = cursor.fetchone()
     return user is None
 
 @st.cache_data(ttl=None, show_spinner=True)
 def check_email_exists(email_forgot_passwd: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT username FROM users WHERE email = %s', (email_forgot_passwd,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT username FROM users WHERE email = %s', (email_forgot_passwd,))
+        user = cursor.fetchone()
     if user:
         return True, user[0]  # user[0] é o username
     return False, None
 
 def check_current_passwd(email_reset_passwd: str, current_passwd: str) -> bool:
-    conn = get_db_connection()
     ph = PasswordHasher()
-    cursor = conn.cursor()
-    cursor.execute('SELECT password FROM users WHERE email = %s', (email_reset_passwd,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        cursor.execute('SELECT password FROM users WHERE email = %s', (email_reset_passwd,))
+        user = cursor.fetchone()
     if user:
         try:
             return ph.verify(user[0], current_passwd)  # user[0] é o password
@@ -317,16 +324,14 @@ def send_passwd_in_email(auth_token: str, username_forgot_passwd: str, email_for
     )
 
 def change_passwd(email_: str, random_password: str) -> None:
-    conn = get_db_connection()
     ph = PasswordHasher()
     hashed_password = ph.hash(random_password)
-    cursor = conn.cursor()
-    try:
-        cursor.execute('UPDATE users SET password = %s WHERE email = %s', (hashed_password, email_))
-        conn.commit()
-    except psycopg2.Error as err:
-        print(f"Error: {err}")
-        conn.rollback()
-    finally:
-        cursor.close()
-        conn.close()
+    with conexao() as conn, conn.cursor() as cursor:
+        try:
+            cursor.execute('UPDATE users SET password = %s WHERE email = %s RETURNING username', (hashed_password, email_))
+            alterados = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            revogar_sessoes_usuario(*alterados)
+        except psycopg2.Error as err:
+            print(f"Error: {err}")
+            conn.rollback()
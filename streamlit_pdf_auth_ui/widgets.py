@@ -1,4 +1,3 @@
-import json
 import os
 import pandas as pd
 import streamlit as st
@@ -10,11 +9,12 @@ from datetime import datetime, timedelta
 from st_keyup import st_keyup
 from .utils import (check_usr_pass, check_valid_name, check_valid_email, 
                     check_unique_email, check_unique_usr, delete_user, 
-                    list_users, register_new_usr, check_email_exists, 
+                    register_new_usr, check_email_exists, 
                     generate_random_passwd, send_passwd_in_email, 
                     change_passwd, create_user_type, 
-                    list_user_types, update_user, update_user_type, 
-                    delete_user_type)
+                    list_user_types, update_user, update_user_type,
+                    delete_user_type, list_users_page, list_user_types_page)
+from .sessao import emitir_token, validar_token, revogar_token
 import extra_streamlit_components as stx
 from PIL import Image
 import base64
@@ -43,6 +43,49 @@ class __login__:
     def delete_cookie(self, key):
         self.cookie_manager.delete(key)
 
+    PAGE_SIZE = 50
+
+    def paged_table(self, key: str, fetch_page, search_label: str, empty_message: str):
+        """Tabela paginada no banco: busca + botões de página anterior/próxima.
+
+        `fetch_page(search, after, limit)` retorna (linhas, próximo cursor).
+        A pilha de cursores fica no session_state e volta para a primeira
+        página quando a busca muda.
+        """
+        search_query = st_keyup(search_label, key=f"search_{key}")
+        state = st.session_state.setdefault(f"{key}_pages", {'search': None, 'cursors': [None]})
+        if state['search'] != search_query:
+            state['search'] = search_query
+            state['cursors'] = [None]
+
+        rows, next_cursor = fetch_page(search_query or None, state['cursors'][-1], self.PAGE_SIZE)
+        if rows:
+            df = pd.DataFrame(rows)
+            df.reset_index(drop=True, inplace=True)  # Remove o índice numérico
+            st.table(df)
+        else:
+            st.write(empty_message)
+
+        col_prev, col_page, col_next = st.columns([1, 2, 1])
+        with col_prev:
+            if len(state['cursors']) > 1 and st.button("◀ Previous", key=f"{key}_prev"):
+                state['cursors'].pop()
+                st.rerun()
+        with col_page:
+            st.write(f"Page {len(state['cursors'])}")
+        with col_next:
+            if next_cursor is not None and st.button("Next ▶", key=f"{key}_next"):
+                state['cursors'].append(next_cursor)
+                st.rerun()
+
+    def select_user(self, key: str):
+        """Busca + selectbox com a primeira página de usuários que casam; retorna (username, id)"""
+        search_query = st_keyup("Search user", key=f"search_{key}")
+        users, _ = list_users_page(search_query or None, None, self.PAGE_SIZE)
+        user_mapping = {u['username']: u['id'] for u in users}
+        selected_username = st.selectbox("Select User", list(user_mapping.keys()), key=f"select_{key}")
+        return selected_username, user_mapping.get(selected_username)
+
     def get_image_base64(self, image_path):
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode()
@@ -80,21 +123,8 @@ class __login__:
                     st.success(f"User type '{type_name}' created successfully.")
 
         elif choice == "Read":
-            user_types = list_user_types()
-            if user_types:
-                # Converte a lista de dicionários para um DataFrame
-                df_user_types = pd.DataFrame(user_types)
-                df_user_types.reset_index(drop=True, inplace=True)  # Remove o índice numérico
-
-                # Campo de busca
-                search_query = st_keyup("Search by type name", key="search_user_type")
-
-                if search_query:
-                    df_user_types = df_user_types[df_user_types['type_name'].str.contains(search_query, case=False, na=False)]
-
-                st.table(df_user_types)
-            else:
-                st.write("No user types found.")
+            # Busca e paginação feitas no banco
+            self.paged_table("user_type", list_user_types_page, "Search by type name", "No user types found.")
 
         elif choice == "Update":
             user_types = list_user_types()
@@ -126,52 +156,25 @@ class __login__:
             self.admin_create_user_widget()
 
         elif choice == "Read":
-            users = list_users()
-            if users:
-                user_types = list_user_types()
-                type_id_to_name = {ut['id']: ut['type_name'] for ut in user_types}
-                
-                # Remova o campo password e substitua user_type_id por type_name
-                for user in users:
-                    user['type_name'] = type_id_to_name.get(user.pop('user_type_id'), 'Unknown')
-                    user.pop('password', None)
-                
-                # Converte a lista de dicionários para um DataFrame
-                df_users = pd.DataFrame(users)
-                df_users.reset_index(drop=True, inplace=True)  # Remove o índice numérico
-
-                # Campo de busca
-                search_query = st_keyup("Search by username", key="search_user")
-
-                if search_query:
-                    df_users = df_users[df_users['username'].str.contains(search_query, case=False, na=False)]
-
-                st.table(df_users)
-            else:
-                st.write("No users found.")
+            # Busca, join com o tipo e paginação feitos no banco; o hash da senha nem é lido
+            self.paged_table("user", list_users_page, "Search by username", "No users found.")
 
         elif choice == "Update":
-            users = list_users()
-            user_mapping = {u['username']: u['id'] for u in users}
-            selected_username = st.selectbox("Select User", list(user_mapping.keys()))
+            selected_username, user_id = self.select_user("update_user")
             new_username = st.text_input("New Username")
             new_email = st.text_input("New Email")
             user_types = list_user_types()
             new_user_type = st.selectbox("New User Type", [ut['type_name'] for ut in user_types])
             update_button = st.button("Update")
-            if update_button:
-                user_id = user_mapping[selected_username]
+            if update_button and user_id:
                 user_type_id = next((ut['id'] for ut in user_types if ut['type_name'] == new_user_type), None)
                 update_user(user_id, new_username, new_email, user_type_id)
                 st.success("User updated successfully.")
 
         elif choice == "Delete":
-            users = list_users()
-            user_mapping = {u['username']: u['id'] for u in users}
-            selected_username = st.selectbox("Select User", list(user_mapping.keys()))
+            selected_username, user_id = self.select_user("delete_user")
             delete_button = st.button("Delete")
-            if delete_button:
-                user_id = user_mapping[selected_username]
+            if delete_button and user_id:
                 delete_user(user_id)
                 st.success("User deleted successfully.")
 
@@ -220,22 +223,16 @@ class __login__:
                         st.session_state['USER_TYPE'] = user_type
                         st.session_state['USERNAME'] = username
                         st.session_state['SELECTED_MENU'] = 'PDF Upload'  # Definindo menu padrão
-                        expiration_date = (datetime.utcnow() + timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%S GMT")
+                        expiry_days = int(config['cookie'].get('expiry_days', 30))
 
-                        # Cria o dicionário de dados da sessão
-                        session_data = {
-                            'user_id': username,
-                            'expires': expiration_date
-                        }
+                        # Token assinado com usuário, tipo e validade (ver sessao.py)
+                        token = emitir_token(username, user_type, dias=expiry_days)
 
                         # Salva na sessão persistente
-                        st.session_state['persistent_session'] = session_data
-
-                        # Serializa o dicionário para uma string JSON (para cookie)
-                        cookie_data_json = json.dumps(session_data)
+                        st.session_state['persistent_session'] = token
 
                         # Define o cookie também
-                        self.set_cookie('__streamlit_login_signup_ui_username__', cookie_data_json, days_expire=30)
+                        self.set_cookie('__streamlit_login_signup_ui_username__', token, days_expire=expiry_days)
                         st.rerun()
 
         if st.session_state.get('LOGGED_IN', False):
@@ -361,10 +358,11 @@ class __login__:
         st.session_state['USERNAME'] = None
         st.session_state['SELECTED_MENU'] = None
         
-        # Remove a sessão persistente
-        if 'persistent_session' in st.session_state:
-            del st.session_state['persistent_session']
-        
+        # Remove a sessão persistente e revoga o token no servidor
+        token = st.session_state.pop('persistent_session', None) or self.get_cookie('__streamlit_login_signup_ui_username__')
+        if token:
+            revogar_token(token)
+
         # Remove o cookie
         self.delete_cookie('__streamlit_login_signup_ui_username__')
         st.rerun()
@@ -400,49 +398,33 @@ class __login__:
         </style> """, unsafe_allow_html=True)
 
     def check_cookie_session(self):
-        """Verifica se existe uma sessão válida nos cookies"""
-        try:
-            cookie_data = self.get_cookie('__streamlit_login_signup_ui_username__')
-            if cookie_data:
-                # Verifica se cookie_data já é um dicionário
-                if isinstance(cookie_data, dict):
-                    cookie_info = cookie_data
-                else:
-                    cookie_info = json.loads(cookie_data)
-                
-                expiration_date = datetime.strptime(cookie_info['expires'], "%Y-%m-%dT%H:%M:%S GMT")
-                
-                # Verifica se o cookie não expirou
-                if expiration_date > datetime.utcnow():
-                    return True, cookie_info['user_id']
-                else:
-                    # Cookie expirado, remove
-                    self.delete_cookie('__streamlit_login_signup_ui_username__')
-        except (json.JSONDecodeError, KeyError, ValueError) as e:
-            # Cookie inválido, remove
+        """Verifica se existe uma sessão válida nos cookies.
+
+        Retorna (válida, username, user_type). O cookie guarda um token
+        assinado; usuário e tipo vêm dele, sem consulta ao banco.
+        """
+        token = self.get_cookie('__streamlit_login_signup_ui_username__')
+        if token:
+            payload = validar_token(token)
+            if payload:
+                st.session_state['persistent_session'] = token
+                return True, payload['u'], payload['t']
+            # Token inválido, expirado, revogado ou no formato antigo: remove
             self.delete_cookie('__streamlit_login_signup_ui_username__')
-        
-        return False, None
+
+        return False, None, None
 
     def check_persistent_session(self):
         """Verifica se existe uma sessão persistente no session_state"""
-        try:
-            if 'persistent_session' in st.session_state:
-                session_data = st.session_state['persistent_session']
-                expiration_date = datetime.strptime(session_data['expires'], "%Y-%m-%dT%H:%M:%S GMT")
-                
-                # Verifica se a sessão não expirou
-                if expiration_date > datetime.utcnow():
-                    return True, session_data['user_id']
-                else:
-                    # Sessão expirada, remove
-                    del st.session_state['persistent_session']
-        except (KeyError, ValueError) as e:
+        token = st.session_state.get('persistent_session')
+        if token:
+            payload = validar_token(token)
+            if payload:
+                return True, payload['u'], payload['t']
             # Sessão inválida, remove
-            if 'persistent_session' in st.session_state:
-                del st.session_state['persistent_session']
-        
-        return False, None
+            del st.session_state['persistent_session']
+
+        return False, None, None
 
     def build_login_ui(self):
         if 'LOGGED_IN' not in st.session_state:
@@ -453,19 +435,17 @@ class __login__:
         # Verifica se há uma sessão válida nos cookies ou session_state
         if not st.session_state['LOGGED_IN']:
             # Primeiro tenta verificar a sessão persistente
-            session_valid, username = self.check_persistent_session()
+            session_valid, username, user_type = self.check_persistent_session()
             if not session_valid:
                 # Se não há sessão persistente, tenta verificar cookies
-                session_valid, username = self.check_cookie_session()
-            
+                session_valid, username, user_type = self.check_cookie_session()
+
             if session_valid and username:
-                # Recupera informações do usuário do banco
-                authenticated, user_type = check_usr_pass(username, "")
-                if authenticated:
-                    st.session_state['LOGGED_IN'] = True
-                    st.session_state['USER_TYPE'] = user_type
-                    st.session_state['USERNAME'] = username
-                    st.session_state['SELECTED_MENU'] = 'PDF Upload'
+                # O tipo vem do token assinado; revogações cobrem troca de senha e alterações do usuário
+                st.session_state['LOGGED_IN'] = True
+                st.session_state['USER_TYPE'] = user_type
+                st.session_state['USERNAME'] = username
+                st.session_state['SELECTED_MENU'] = 'PDF Upload'
 
         self.login_widget()
         self.logout_widget()